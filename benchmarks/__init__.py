@@ -0,0 +1,9 @@
+"""\
+Benchmarks of dblike.
+
+- generator - synthetic schemas of configurable size and shape
+- run - timing of main operations, results are written as JSON
+
+Usage (from repository root):
+    python -m benchmarks.run --rows 100000 --output results.json
+"""
@@ -0,0 +1,64 @@
+"""\
+Synthetic schema generator for benchmarks.
+
+Generated schema is a chain of tables t0, t1, ..., where each row of table
+`t<i>` refers to a row of table `t<i+1>` through column `parent_id`.
+Each next table has `fanout` times less rows, so on average `fanout` rows
+refer to the same parent row.
+
+Columns of each row:
+- id - pk, `int` starting from 1 (`deref` needs true value)
+- parent_id - reference to next table (`None` in the last table)
+- category - `str` with `cardinality` distinct values
+- number - `int` with `cardinality` distinct values
+- name - unique `str`
+"""
+
+import random
+from collections import namedtuple
+
+from dblike import DBSchema, TableDef
+
+
+# Shape of generated schema.
+# tables - number of tables, rows - number of rows in first table,
+# fanout - rows referring to the same parent row,
+# cardinality - distinct values of `category` and `number` columns.
+SchemaShape = namedtuple('SchemaShape', 'tables rows fanout cardinality')
+
+
+def table_names(shape):
+    """Return names of generated tables (from the biggest one)."""
+    return ['t{}'.format(i) for i in range(shape.tables)]
+
+
+def table_rows(shape, table_no):
+    """Return number of rows of table `table_no`."""
+    return max(1, shape.rows // (shape.fanout ** table_no))
+
+
+def generate_rows(shape, table_no, seed=0):
+    """Yield value dicts of table `table_no`."""
+    rnd = random.Random('{}-{}'.format(seed, table_no))
+    is_last = table_no == shape.tables - 1
+    parent_rows = None if is_last else table_rows(shape, table_no + 1)
+    for i in range(table_rows(shape, table_no)):
+        yield {
+            'id': i + 1,
+            'parent_id': None if is_last else rnd.randrange(parent_rows) + 1,
+            'category': 'category{}'.format(rnd.randrange(shape.cardinality)),
+            'number': rnd.randrange(shape.cardinality),
+            'name': 'name{}-{}'.format(table_no, i),
+        }
+
+
+def generate_schema(shape, storage=None, seed=0):
+    """Create `DBSchema` and load generated rows into it.
+
+    :param storage: `TableDef.storage` of all tables.
+    """
+    names = table_names(shape)
+    schema = DBSchema([TableDef(name, 'id', storage) for name in names])
+    for table_no, name in enumerate(names):
+        schema[name].add_rows(generate_rows(shape, table_no, seed))
+    return schema
@@ -0,0 +1,169 @@
+"""\
+Time main dblike operations on generated schemas.
+
+Each storage is measured in separate process, so that memory used
+by one storage does not affect results of others.
+Results are written as JSON:
+
+    {"dblike_version": ..., "python_version": ..., "shape": {...},
+     "results": [{"storage": ..., "benchmark": ..., "ops": ...,
+                  "seconds": ..., "seconds_per_op": ...}, ...]}
+
+Result of "memory" benchmark has "bytes_per_row" instead of times.
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+import dblike
+from dblike import DBSchema, TableDef
+from .generator import SchemaShape, generate_rows, generate_schema, table_names, table_rows
+
+
+STORAGES = ('dict', 'compact', 'columnar', 'sqlite')
+
+
+def benchmark_storage(shape, storage, lookups=10000, seed=0):
+    """Run all benchmarks for one storage.
+
+    Memory is measured as growth of peak RSS, so it is meaningful
+    only in fresh process.
+
+    :returns: `list` of result `dict`.
+    """
+    results = list()
+    def record(benchmark, ops, seconds):
+        results.append({'storage': storage, 'benchmark': benchmark,
+            'ops': ops, 'seconds': seconds, 'seconds_per_op': seconds / max(ops, 1)})
+    rnd = random.Random(seed)
+    names = table_names(shape)
+    child, parent = names[0], names[min(1, len(names) - 1)]
+
+    rss_before = _max_rss()
+    schema = generate_schema(shape, storage, seed)
+    rss_after = _max_rss()
+    total_rows = sum(table_rows(shape, i) for i in range(shape.tables))
+    results.append({'storage': storage, 'benchmark': 'memory', 'rows': total_rows,
+        'bytes_per_row': None if rss_before is None
+            else float(rss_after - rss_before) / total_rows})
+
+    value_dicts = list(generate_rows(shape, 0, seed))
+    table = DBSchema([TableDef('x', 'id', storage)]).x
+    started = time.time()
+    for value_dict in value_dicts:
+        table.add_row(value_dict)
+    record('add_row', len(value_dicts), time.time() - started)
+    table = DBSchema([TableDef('x', 'id', storage)]).x
+    started = time.time()
+    table.add_rows(value_dicts)
+    record('add_rows', len(value_dicts), time.time() - started)
+    del table, value_dicts
+
+    table = schema[child]
+    categories = ['category{}'.format(rnd.randrange(shape.cardinality))
+        for i in range(lookups)]
+    started = time.time()
+    table.find_rows('category', [categories[0]])
+    record('find_rows_cold', 1, time.time() - started)
+    started = time.time()
+    for category in categories:
+        table.find_rows('category', [category])
+    record('find_rows_warm', lookups, time.time() - started)
+    scans = max(1, lookups // 1000)
+    started = time.time()
+    for i in range(scans):
+        table.find_rows('number', [i % shape.cardinality], skip_index=True)
+    record('find_rows_skip_index', scans, time.time() - started)
+
+    row_ids = [rnd.randrange(table_rows(shape, 0)) + 1 for i in range(lookups)]
+    started = time.time()
+    for row_id in row_ids:
+        table[row_id]
+    record('getitem', lookups, time.time() - started)
+
+    parent_rows = [schema[parent][rnd.randrange(table_rows(shape, 1)) + 1]
+        for i in range(lookups)] if parent != child else list()
+    if parent_rows:
+        parent_rows[0].find_refs(child, 'parent_id') # build index
+        started = time.time()
+        for row in parent_rows:
+            row.find_refs(child, 'parent_id')
+        record('find_refs', lookups, time.time() - started)
+        values = [table[row_id].parent_id for row_id in row_ids]
+        started = time.time()
+        for value in values:
+            value.deref(parent)
+        record('deref', lookups, time.time() - started)
+
+    started = time.time()
+    for row_id, row in table.iteritems():
+        pass
+    record('iteritems', table_rows(shape, 0), time.time() - started)
+    return results
+
+
+def _max_rss():
+    """Return peak RSS of this process in bytes, `None` if unknown."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tables', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=100000,
+        help='rows of the biggest table')
+    parser.add_argument('--fanout', type=int, default=10,
+        help='rows referring to the same parent row')
+    parser.add_argument('--cardinality', type=int, default=100,
+        help='distinct values of category and number columns')
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', action='append', choices=STORAGES,
+        help='storage to be measured (repeatable), default - all')
+    parser.add_argument('--output', help='JSON file, default - stdout')
+    parser.add_argument('--single', action='store_true',
+        help='measure one storage in this process (used internally)')
+    args = parser.parse_args(argv)
+    shape = SchemaShape(args.tables, args.rows, args.fanout, args.cardinality)
+    storages = args.storage or STORAGES
+    if args.single:
+        results = benchmark_storage(shape, storages[0], args.lookups, args.seed)
+        json.dump(results, sys.stdout)
+        return
+    results = list()
+    for storage in storages:
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.run',
+            '--single', '--storage', storage,
+            '--tables', str(args.tables), '--rows', str(args.rows),
+            '--fanout', str(args.fanout), '--cardinality', str(args.cardinality),
+            '--lookups', str(args.lookups), '--seed', str(args.seed)])
+        results.extend(json.loads(output.decode('utf-8')))
+    report = {
+        'dblike_version': dblike.__version__,
+        'python_version': platform.python_version(),
+        'shape': shape._asdict(),
+        'lookups': args.lookups,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
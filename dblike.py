@@ -9,6 +9,12 @@ This module provides classes, that loosely correspond to database concepts:
 - _DBRow - dict of values
 - _DBValue
 
+Tables can keep rows in other storages (`TableDef.storage`):
+``'compact'`` - tuples of values, ``'columnar'`` - arrays of columns,
+``'sqlite'`` - SQLite database. Schema can also be saved as a snapshot,
+that is opened lazily (`DBSchema.open_snapshot`), or frozen into
+a read-only copy (`DBSchema.freeze`).
+
 Specific situation, when it can be useful:
 - Data is structured similarly as DB (e.g. XML dump of database schema).
 - There is no possibility to actually load data to DB.
@@ -16,18 +22,59 @@ Specific situation, when it can be useful:
 - It is easy/quick to load data into dblike.
 
 It will not be useful if real database is needed.
-- No data consistency checks
+- Only unique primary keys are enforced, references are checked on demand
+  (`DBSchema.check_references`)
 - No data types
 - No transactions
-- No optimizations
-- No data updates
+- Only simple optimizations (hash and sorted indexes, built on demand)
+- No data updates, rows can only be added or replaced by primary key
 """
 
 
 __version__ = '2.3.0'
 
 
-from collections import namedtuple
+import gc
+import io
+import marshal
+import mmap
+import multiprocessing
+import os
+import operator
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from itertools import chain, count, product
+from operator import itemgetter
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping # Python 2 compatibility.
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle # Python 3 compatibility.
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # optional, used by `_ColumnarTable`
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None # optional, used by `_SQLiteTable`
 
 
 class DuplicateRowException(Exception):
@@ -86,24 +133,439 @@ class BrokenReferenceError(RowKeyError):
 
 
 # Table definition used by DBSchema.
-# Contains name (string) and primary key (list or string that is later split)
-TableDef = namedtuple('TableDef', 'name pk')
+# Contains name (string), primary key (list or string that is later split),
+# optional storage name (key of `_TABLE_STORAGES`, e.g. 'compact'),
+# optional foreign keys (dict: column names -> referenced table name,
+# column names are list or string that is later split)
+# optional columns, whose values are interned (list or string that is
+# later split, `True` - all columns; see `_DBTable._intern_values`)
+# and optional loader of rows, that is run when table is first accessed
+# (see `DBSchema._load_table`).
+TableDef = namedtuple('TableDef', 'name pk storage refs intern loader')
+TableDef.__new__.__defaults__ = (None, None, None, None)
 
 
 class DBSchema(object):
     """Contains dict of _DBTable."""
 
-    def __init__(self, schema_def):
-        """Create DBSchema from list of TableDef."""
+    def __init__(self, schema_def, thread_safe=False, sqlite_path='',
+            sqlite_cache_rows=100000):
+        """Create DBSchema from list of TableDef.
+
+        :param thread_safe: Allow concurrent use of tables from many threads,
+            see `_LockedTableMixin`.
+        :param sqlite_path: SQLite database file of tables with ``'sqlite'``
+            storage (see `_SQLiteTable`), ``''`` - temporary file,
+            that is deleted when schema is garbage collected.
+        :param sqlite_cache_rows: Number of decoded rows cached
+            by each table with ``'sqlite'`` storage.
+        """
         self._tables = dict()
-        for name, pk in schema_def:
-            self._tables[name] = _DBTable(self, name, pk)
+        self._thread_safe = thread_safe
+        self._sqlite_path = sqlite_path
+        self._sqlite_cache_rows = sqlite_cache_rows
+        self._sqlite = None # connection, see `_sqlite_connection`
+        self._loaders = dict() # table name -> `TableDef.loader` not run yet
+        self._loading = set() # names of tables, whose loader is running
+        self._load_lock = threading.RLock()
+        for table_def in schema_def:
+            name, pk, storage, refs, intern, loader = TableDef(*table_def)
+            table = self._table_class(_TABLE_STORAGES[storage])(self, name, pk)
+            if intern:
+                table._intern = True if intern is True else frozenset(_tupleize_cols(intern))
+            for column_names, ref_table in (refs or dict()).items():
+                column_names = _tupleize_cols(column_names)
+                table._refs[column_names] = ref_table
+                # Index for `find_refs`, it is maintained while adding rows.
+                table._index_create(_sort_columns(column_names)[0])
+            self._tables[name] = table
+            if loader is not None:
+                self._loaders[name] = loader
 
     # Forward some methods to internal dict.
-    def __getattr__(self, table_name): return self._tables[table_name]
-    def __getitem__(self, table_name): return self._tables[table_name]
+    def __getattr__(self, table_name): return self[table_name]
     def __contains__(self, table_name): return table_name in self._tables
 
+    def __getitem__(self, table_name):
+        table = self._tables[table_name]
+        if table_name in self._loaders:
+            self._load_table(table_name)
+        return table
+
+    def _load_table(self, table_name):
+        """Run `TableDef.loader` of the table, if it was not run yet.
+
+        Loader is one of:
+        - function without arguments, that returns iterable of `value_dict`;
+        - path of file written by `save_snapshot`, which contains
+          table with the same name;
+        - `list` or `tuple` of the above (shards of the table).
+
+        Rows are added by `_DBTable.add_rows`, so if loader fails,
+        table stays empty and loader is run again on next access.
+        Loader may access other tables of the schema (e.g. by `_DBValue.deref`),
+        its own table is seen as not loaded yet.
+
+        :raises DuplicateRowException:
+        """
+        with self._load_lock:
+            if table_name not in self._loaders or table_name in self._loading:
+                return
+            self._loading.add(table_name)
+            try:
+                self._tables[table_name].add_rows(
+                    _loader_rows(self._loaders[table_name], table_name))
+            finally:
+                self._loading.discard(table_name)
+            del self._loaders[table_name]
+
+    @classmethod
+    def from_xml(cls, source, mapping, on_duplicate='raise'):
+        """Create DBSchema and load it from XML (see `load_xml`).
+
+        :param mapping: Element tag -> `TableDef` of the table,
+            into which such elements are loaded.
+        :type mapping: `dict`.
+        """
+        schema_def = dict((t.name, t) for t in mapping.values()).values()
+        schema = cls(schema_def)
+        schema.load_xml(source,
+            dict((tag, t.name) for tag, t in mapping.items()), on_duplicate)
+        return schema
+
+    def load_xml(self, source, mapping, on_duplicate='raise', batch_size=10000):
+        """Load rows from XML, without building whole XML tree in memory.
+
+        Each element with tag listed in `mapping` becomes one row.
+        Values of the row are taken from attributes of that element
+        and from texts of its child elements (column name is attribute name
+        or child tag). Values are not converted, so they are strings.
+
+        Processed elements are removed from the tree while parsing,
+        so memory usage is bounded by loaded tables (not by XML size).
+
+        :param source: File name or file object.
+        :param mapping: Element tag -> name of the table,
+            into which such elements are loaded.
+        :param on_duplicate: See `_DBTable.add_rows`.
+            Rows are added in batches of `batch_size`, so in case of
+            `DuplicateRowException` previous batches stay loaded.
+        :type mapping: `dict`.
+        :raises DuplicateRowException:
+        """
+        batches = dict((tag, list()) for tag in mapping)
+        for tag, value_dict in _iter_xml_rows(source, mapping):
+            batch = batches[tag]
+            batch.append(value_dict)
+            if len(batch) >= batch_size:
+                self[mapping[tag]].add_rows(batch, on_duplicate)
+                del batch[:]
+        for tag, batch in batches.items():
+            self[mapping[tag]].add_rows(batch, on_duplicate)
+
+    def save_snapshot(self, path, indexes=False):
+        """Save all tables into binary file, see `open_snapshot`.
+
+        Column values must be supported by `marshal`.
+
+        :param indexes: Save also indexes, that currently exist.
+        :type indexes: `bool`.
+        """
+        with open(path, 'wb') as f:
+            self._write_snapshot(f, indexes)
+
+    def _write_snapshot(self, f, indexes, write_map=None):
+        """Write snapshot of all tables into file object `f`.
+
+        :param write_map: See `_DBTable._write_snapshot`.
+        """
+        f.write(_SNAPSHOT_MAGIC)
+        header = [self[name]._write_snapshot(f, indexes, write_map)
+            for name in self._tables]
+        header_pos = f.tell()
+        f.write(marshal.dumps(header))
+        f.write(struct.pack('<Q', header_pos))
+
+    @classmethod
+    def open_snapshot(cls, path, thread_safe=False):
+        """Create DBSchema from file written by `save_snapshot`.
+
+        File is memory-mapped (so its pages are shared between processes)
+        and rows are decoded only when they are accessed.
+        Decoded rows are cached by their table.
+
+        :param thread_safe: See `DBSchema.__init__`.
+        """
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            raise ValueError('Not a dblike snapshot: {}'.format(path))
+        return cls._from_snapshot(buf, _SnapshotTable, thread_safe)
+
+    def freeze(self):
+        """Return read-only copy of the schema, see `_FrozenTable`.
+
+        All rows, pk lookup and currently existing indexes are encoded
+        into one `bytes` buffer (layout of `save_snapshot`, with hash tables
+        of `_FrozenHashTable` instead of marshalled dicts), so after `os.fork`
+        the copy is shared by processes: it is not written to by reference
+        counting, as it would happen with per-row and per-value objects.
+        Hash tables depend on `hash` of this process (and its forks),
+        so the buffer must not be saved.
+        Tables with `TableDef.loader` are loaded first.
+
+        Column values must be supported by `marshal`.
+        Adding rows to the copy raises `TypeError`.
+        """
+        f = io.BytesIO()
+        self._write_snapshot(f, indexes=True, write_map=_write_hash_table)
+        return self._from_snapshot(f.getvalue(), _FrozenTable, self._thread_safe)
+
+    @classmethod
+    def _from_snapshot(cls, buf, table_class, thread_safe):
+        """Create DBSchema with tables of `table_class` from snapshot in `buf`."""
+        header_pos, = struct.unpack_from('<Q', buf, len(buf) - 8)
+        header = marshal.loads(buf[header_pos:len(buf) - 8])
+        schema = cls([], thread_safe)
+        for entry in header:
+            table = schema._table_class(table_class)(
+                schema, entry['name'], entry['pk'], buf, entry)
+            table._refs.update(entry.get('refs', dict()))
+            table._intern = entry.get('intern')
+            schema._tables[entry['name']] = table
+        return schema
+
+    def check_references(self):
+        """Check all foreign keys declared in `TableDef.refs`.
+
+        Falsy values (and missing columns) are not references, so they are
+        not checked (same as `_DBValue.deref` can not be used for them).
+
+        :returns: Error for each broken reference.
+        :rtype: `list` of `BrokenReferenceError`.
+        """
+        errors = list()
+        for name in self._tables:
+            table = self._tables[name]
+            if table._refs:
+                self._load_table(name)
+            for column_names, ref_table_name in table._refs.items():
+                ref_table = self[ref_table_name]
+                ref_rows = ref_table._rows
+                column = column_names[0] if len(column_names) == 1 else column_names
+                with table._lock.reading():
+                    rows = table._rows.items()
+                for pk_value, row in rows:
+                    key = _row_key(row, column_names)
+                    if key is not None and key not in ref_rows and any(key):
+                        errors.append(BrokenReferenceError(
+                            (table._name, table._pk, pk_value), column,
+                            (ref_table._name, ref_table._pk, key)))
+        return errors
+
+    def deref_many(self, values, table_name, missing='raise'):
+        """Dereference many values at once, see `_DBValue.deref`.
+
+        :param values: Values to be used as keys in the supplied table.
+        :param table_name: Name of the table in which to dereference.
+        :param missing: What to return for not found row:
+            ``'raise'`` - raise `BrokenReferenceError`;
+            ``'none'`` - `None`;
+            ``'skip'`` - nothing (result is not aligned with `values`).
+        :type values: iterable of `_DBValue`.
+        :returns: Found rows, in order of `values`. Falsy values
+            (no reference) give `None` (or nothing if ``missing='skip'``).
+        :rtype: `list` of `_DBRow`.
+        :raises BrokenReferenceError:
+        """
+        _check_missing(missing)
+        table = self[table_name]
+        rows = table._rows
+        result = list()
+        derefs = broken = 0
+        for value in values:
+            row_id = value.value
+            row = None
+            if row_id:
+                row = rows.get(_tupleize_row_id(row_id))
+                if row is None:
+                    if missing == 'raise':
+                        table._stats.count('derefs', derefs)
+                        table._stats.count('broken_references', broken)
+                        value.deref(table_name) # raises BrokenReferenceError
+                    broken += 1
+                derefs += 1
+            if row is None and missing == 'skip':
+                continue
+            result.append(row)
+        table._stats.count('derefs', derefs)
+        table._stats.count('broken_references', broken)
+        return result
+
+    def join(self, left_table, left_cols, right_table, right_cols, how='inner'):
+        """Join rows of two tables, where column values are equal.
+
+        :optimization:
+            Hash join: index of one table (existing one,
+            or created on the smaller table) is probed by rows of other table.
+
+        :param left_cols: Columns of `left_table` to be compared.
+        :param right_cols: Columns of `right_table`
+            (corresponding to `left_cols`) to be compared.
+        :param how: ``'inner'`` - only matched pairs;
+            ``'left'`` - also ``(left_row, None)`` for unmatched left rows.
+        :type left_cols:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+        :type right_cols:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+
+        :returns: Iterator of (left_row, right_row) pairs.
+            Order of pairs is not defined.
+        """
+        if how not in ('inner', 'left'):
+            raise ValueError('Unknown how: {!r}'.format(how))
+        left_cols = _tupleize_cols(left_cols)
+        right_cols = _tupleize_cols(right_cols)
+        if len(left_cols) != len(right_cols):
+            raise ValueError('Different number of columns: {} and {}'.format(
+                left_cols, right_cols))
+        left, right = self[left_table], self[right_table]
+        # Index columns are sorted, probing columns are ordered to match them.
+        right_index_cols, order = _sort_columns(right_cols)
+        right_probe_cols = _reorder(left_cols, order)
+        left_index_cols, order = _sort_columns(left_cols)
+        left_probe_cols = _reorder(right_cols, order)
+        if right._index_exists(right_index_cols):
+            index_left = False
+        elif left._index_exists(left_index_cols):
+            index_left = True
+        else:
+            index_left = len(left._rows) < len(right._rows)
+        if index_left:
+            return _join_probe_left(
+                left, left_index_cols, right, left_probe_cols, how == 'left')
+        else:
+            return _join_probe_right(
+                left, right_probe_cols, right, right_index_cols, how == 'left')
+
+    def load_parallel(self, shards, parse, processes=None, on_duplicate='raise'):
+        """Parse shards in worker processes and load rows into tables.
+
+        Workers send rows back as compact batches (column names are sent
+        once per distinct set of columns), which are added to tables
+        in order of `shards` by `_DBTable.add_rows`.
+
+        :param shards: Shard descriptions (e.g. file names) for `parse`.
+        :param parse: Function: shard -> iterable of (table name, value_dict).
+            It must be picklable (defined at module level).
+        :param processes: Number of worker processes,
+            `None` - number of CPUs, ``1`` - parse in this process.
+        :param on_duplicate: See `_DBTable.add_rows`.
+            It is applied shard by shard, so in case of
+            `DuplicateRowException` previous shards stay loaded.
+        :raises DuplicateRowException:
+        """
+        tasks = [(parse, shard) for shard in shards]
+        if processes == 1:
+            self._load_batches((_parse_shard(task) for task in tasks), on_duplicate)
+            return
+        pool = multiprocessing.Pool(processes)
+        try:
+            self._load_batches(pool.imap(_parse_shard, tasks), on_duplicate)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _load_batches(self, batches, on_duplicate):
+        """Add rows, that were encoded by `_parse_shard`."""
+        for batch in batches:
+            for table_name, (layouts, rows) in batch:
+                self[table_name].add_rows(
+                    (dict(zip(layouts[row[0]], row[1:])) for row in rows),
+                    on_duplicate)
+
+    def stats(self):
+        """Return counters of each table, see `_DBTable.stats`.
+
+        :rtype: `dict` of table name -> `dict`.
+        """
+        return dict((name, table.stats()) for name, table in self._tables.items())
+
+    def set_stats_hook(self, hook):
+        """Set function to be called on each change of table counters.
+
+        :param hook: Function: (table name, counter name, amount) -> `None`.
+            Counter names are as in `_DBTable.stats`.
+            `None` - remove hook.
+        """
+        for table in self._tables.values():
+            table._stats.hook = hook
+
+    def memory_usage(self):
+        """Return approximate memory used by each table, see `_DBTable.memory_usage`.
+
+        :rtype: `dict` of table name -> `dict`.
+        """
+        return dict((name, table.memory_usage()) for name, table in self._tables.items())
+
+    def set_index_budget(self, max_bytes):
+        """Limit memory used by indexes of all tables.
+
+        When indexes (including sorted ones) use more than `max_bytes`,
+        least recently used ones are dropped. Dropped index is rebuilt,
+        when it is needed again. Limit is checked after an index is built
+        and after `_DBTable.add_rows`, index sizes are estimated
+        as in `_DBTable.memory_usage`.
+
+        Order of index use is tracked only while limit is set,
+        so existing indexes are initially treated as used at once.
+
+        :param max_bytes: Memory limit, `None` - no limit.
+        :type max_bytes: `int`.
+        """
+        budgets = set([table._index_budget for table in self._tables.values()])
+        budget = budgets.pop() if len(budgets) == 1 else None
+        if budget is not None and max_bytes is not None:
+            budget.max_bytes = max_bytes # keep order of index use
+            budget.enforce()
+            return
+        budget = None if max_bytes is None else _IndexBudget(max_bytes)
+        for table in self._tables.values():
+            table._index_budget = budget
+            if budget is not None:
+                for column_names in list(table._indexes):
+                    budget.add(table, False, column_names)
+                for column_names in list(table._sorted_indexes):
+                    budget.add(table, True, column_names)
+        if budget is not None:
+            budget.enforce()
+
+    def _sqlite_connection(self):
+        """Return connection shared by tables with ``'sqlite'`` storage."""
+        if self._sqlite is None:
+            self._sqlite = _sqlite_connect(self._sqlite_path)
+        return self._sqlite
+
+    def _table_class(self, table_class):
+        """Return table class, that should be used by this schema."""
+        if not self._thread_safe:
+            return table_class
+        if table_class not in _LOCKED_TABLE_CLASSES:
+            _LOCKED_TABLE_CLASSES[table_class] = type('_Locked' + table_class.__name__,
+                (_LockedTableMixin, table_class), dict())
+        return _LOCKED_TABLE_CLASSES[table_class]
+
+    def load(self, rows_by_table, on_duplicate='raise'):
+        """Bulk load rows into several tables.
+
+        :param rows_by_table: Table name -> iterable of `value_dict`.
+        :param on_duplicate: See `_DBTable.add_rows`.
+        :type rows_by_table: `dict`.
+        :raises DuplicateRowException:
+        """
+        for table_name, value_dicts in rows_by_table.items():
+            self[table_name].add_rows(value_dicts, on_duplicate)
+
 
 class _DBTable(object):
     """Contains dict of _DBRow.
@@ -112,6 +574,8 @@ class _DBTable(object):
     but class it self should be instantiated only by `DBSchema`.
     """
 
+    _row_store = ('_rows', '_intern_pools') # attributes holding rows, see `memory_usage`
+
     def __init__(self, parent_schema, name, pk):
         """Construct empty DBTable.
 
@@ -125,7 +589,15 @@ class _DBTable(object):
         self._name = name # needed only for debug info
         self._pk = pk
         self._rows = dict()
-        self._indexes = dict()
+        self._indexes = dict() # sorted column names -> {column values: set of rows}
+        self._prefix_maps = dict() # see `_index_prefix_lookup`
+        self._sorted_indexes = dict() # column names -> _SortedIndex
+        self._refs = dict() # column names -> referenced table name
+        self._intern = None # columns to be interned, `True` - all, see `TableDef`
+        self._intern_pools = dict() # column name -> {value: shared value}
+        self._lock = _NO_LOCK # see `_LockedTableMixin`
+        self._stats = _TableStats(name)
+        self._index_budget = None # shared by tables, see `DBSchema.set_index_budget`
 
     # Forward some methods to internal dict.
     def __contains__(self, row_id): return _tupleize_row_id(row_id) in self._rows
@@ -144,6 +616,50 @@ class _DBTable(object):
         except KeyError as e:
             raise RowKeyError((self._name, self._pk, e.args[0]))
 
+    def get_many(self, row_ids, missing='raise'):
+        """Return rows by their row_ids/pk_values.
+
+        :param row_ids: pk values of the rows to be returned.
+        :param missing: What to return for not found row:
+            ``'raise'`` - raise `RowKeyError`;
+            ``'none'`` - `None`;
+            ``'skip'`` - nothing (result is not aligned with `row_ids`).
+        :returns: Rows, in order of `row_ids`.
+        :rtype: `list` of `_DBRow`.
+        :raises RowKeyError:
+        """
+        _check_missing(missing)
+        rows = self._rows
+        result = list()
+        for row_id in row_ids:
+            row_id = _tupleize_row_id(row_id)
+            row = rows.get(row_id)
+            if row is None:
+                if missing == 'skip':
+                    continue
+                if missing == 'raise':
+                    raise RowKeyError((self._name, self._pk, row_id))
+            result.append(row)
+        return result
+
+    def row_getter(self):
+        """Return function: row_id -> row, same as `__getitem__`.
+
+        :optimization:
+            Faster alternative to `__getitem__` for many lookups,
+            attributes of the table are resolved once.
+
+        :returns: Function, that raises `RowKeyError` for not found row.
+        """
+        rows, name, pk = self._rows, self._name, self._pk
+        def get_row(row_id):
+            key = row_id if type(row_id) is tuple else (row_id,)
+            try:
+                return rows[key]
+            except KeyError:
+                raise RowKeyError((name, pk, key))
+        return get_row
+
     def add_row(self, value_dict):
         """Add a row into the table.
 
@@ -151,13 +667,102 @@ class _DBTable(object):
         :type value_dict: `dict`.
         :raises DuplicateRowException: In case pk for new row is already taken.
         """
-        self._index_clear_all()
-        new_row = _DBRow(self._schema, self, self._pk, value_dict)
+        if self._intern is not None:
+            value_dict = self._intern_values(value_dict)
+        new_row = self._make_row(value_dict)
         new_pk = new_row._pk_value
         if new_pk in self._rows:
             existing_row = self._rows[new_pk]
             raise DuplicateRowException(self._name, existing_row, new_row)
         self._rows[new_pk] = new_row
+        self._index_add_row(new_row)
+        if self._index_budget is not None:
+            self._index_budget.resized(self)
+
+    def add_rows(self, value_dicts, on_duplicate='raise'):
+        """Add many rows into the table.
+
+        Faster alternative to calling `add_row` for each row.
+        Duplicates are found in one pass over new rows and
+        each existing index is updated once at the end.
+
+        :param value_dicts: Values to be stored. Names->value maps of columns.
+        :param on_duplicate: What to do when pk of new row is already taken:
+            ``'raise'`` - raise `DuplicateRowException`, table is not changed;
+            ``'skip'`` - keep the row that was added first;
+            ``'replace'`` - keep the row that was added last.
+        :type value_dicts: iterable of `dict`.
+        :type on_duplicate: `str`.
+        :raises DuplicateRowException: In case pk for new row is already taken.
+        """
+        if on_duplicate not in ('raise', 'skip', 'replace'):
+            raise ValueError('Unknown on_duplicate: {!r}'.format(on_duplicate))
+        pk_cols = _tupleize_cols(self._pk)
+        rows = self._rows
+        new_rows = dict()
+        replaced = False
+        for value_dict in value_dicts:
+            new_pk = tuple([value_dict[name] for name in pk_cols])
+            if new_pk in new_rows or new_pk in rows:
+                if on_duplicate == 'skip':
+                    continue
+                if on_duplicate == 'raise':
+                    if new_pk in new_rows:
+                        existing_row = new_rows[new_pk]
+                    else:
+                        existing_row = rows[new_pk]
+                    new_row = self._make_row(value_dict)
+                    raise DuplicateRowException(self._name, existing_row, new_row)
+                replaced = replaced or new_pk in rows
+            if self._intern is not None:
+                value_dict = self._intern_values(value_dict)
+            new_rows[new_pk] = self._make_row(value_dict)
+        rows.update(new_rows)
+        if replaced:
+            self._prefix_maps.clear()
+            for column_names in list(self._indexes):
+                self._index_create(column_names)
+            for column_names in list(self._sorted_indexes):
+                self._sorted_index_create(column_names)
+            self._stats.count('index_rebuilds',
+                len(self._indexes) + len(self._sorted_indexes))
+        else:
+            for new_row in new_rows.values():
+                self._index_add_row(new_row, sorted_indexes=False)
+            for sorted_index in list(self._sorted_indexes.values()):
+                sorted_index.add_rows(new_rows.values())
+        if self._index_budget is not None:
+            self._index_budget.resized(self)
+            self._index_budget.enforce()
+
+    def _make_row(self, value_dict):
+        """Construct row (not yet added to the table)."""
+        return _DBRow(self._schema, self, self._pk, value_dict)
+
+    def _intern_values(self, value_dict):
+        """Return copy of `value_dict`, that reuses equal values of previous rows.
+
+        Each interned column (see `TableDef.intern`) has pool of its distinct
+        values, so rows (and index keys made of their values) share one object
+        per distinct value instead of keeping own copies.
+        Value is reused only if it has the same type (``1`` is not ``1.0``).
+        """
+        columns = self._intern
+        pools = self._intern_pools
+        interned = dict()
+        for name, value in value_dict.items():
+            if columns is True or name in columns:
+                pool = pools.get(name)
+                if pool is None:
+                    pool = pools[name] = dict()
+                try:
+                    shared = pool.setdefault(value, value)
+                except TypeError:
+                    shared = value # unhashable value is not shared
+                if type(shared) is type(value):
+                    value = shared
+            interned[name] = value
+        return interned
 
     def find_rows(self, column_names, column_values, skip_index=False):
         """Find rows based on column value filter.
@@ -168,6 +773,9 @@ class _DBTable(object):
         :optimization:
             By default create index before searching, if it does not exist yet.
             This can be disabled by `skip_index`.
+            Index is shared by lookups with any order of the same columns.
+            Existing index on more columns is used instead of creating new one,
+            if its leading columns (in sorted order) are `column_names`.
 
         :param column_names: Column names to be filtered on.
         :param column_values: Column values (corresponding to `column_names`) to be searched.
@@ -182,49 +790,1580 @@ class _DBTable(object):
         :returns: Rows where all columns were matched.
         :rtype: `set` of `_DBRow`.
         """
-        column_names = _tupleize_cols(column_names)
-        column_values = _tupleize_cols(column_values)
+        column_names, order = _sort_columns(_tupleize_cols(column_names))
+        column_values = _reorder(_tupleize_cols(column_values), order)
         if not skip_index:
-            if not self._index_exists(column_names):
-                self._index_create(column_names)
             return self._index_find_rows(column_names, column_values)
         else:
+            self._stats.count('full_scans')
             return self._walking_find_rows(column_names, column_values)
 
+    def scan(self, predicate, processes=1):
+        """Find rows by checking `predicate` on each row.
+
+        :optimization:
+            Rows can be split between forked worker processes.
+            Rows and `predicate` are inherited by workers (not pickled),
+            only positions of matched rows are sent back.
+
+        :param predicate: Function: row -> `bool`. (e.g. lambda)
+        :param processes: Number of worker processes, `None` - number of CPUs,
+            ``1`` - check rows in this process. Without `os.fork` rows
+            are always checked in this process.
+
+        :returns: Rows for which `predicate` is true.
+        :rtype: `set` of `_DBRow`.
+        """
+        self._stats.count('full_scans')
+        rows = list(self._rows.values())
+        if processes == 1 or not hasattr(os, 'fork') or len(rows) < 2:
+            return set([row for row in rows if predicate(row)])
+        # Workers are forked by `Pool`, so they inherit state of this scan.
+        token = next(_scan_tokens)
+        _scan_states[token] = (rows, predicate)
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            context = multiprocessing # Python 2 always forks.
+        pool = context.Pool(processes)
+        try:
+            chunk_size = -(-len(rows) // (4 * (processes or multiprocessing.cpu_count())))
+            chunks = [(token, start, min(start + chunk_size, len(rows)))
+                for start in range(0, len(rows), chunk_size)]
+            found = set()
+            for positions in pool.imap_unordered(_scan_chunk, chunks):
+                found.update([rows[pos] for pos in positions])
+            return found
+        finally:
+            pool.terminate()
+            pool.join()
+            del _scan_states[token]
+
+    def group_by(self, column_names):
+        """Group rows by values of columns.
+
+        :optimization:
+            Existing index on `column_names` is returned (as new dict),
+            otherwise rows are grouped in one pass (index is not created).
+
+        :param column_names: Column names to group on.
+        :type column_names:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+
+        :returns: Column values -> rows having them.
+            Rows without some of the columns are not included.
+        :rtype: `dict` of `tuple` -> `set` of `_DBRow`.
+        """
+        column_names = _tupleize_cols(column_names)
+        index_names, order = _sort_columns(column_names)
+        index = self._index_get(index_names)
+        if index is not None:
+            if order is None:
+                return dict(index)
+            restore = _sort_columns(order)[1] # inverse of `order`
+            return dict((_reorder(key, restore), rows) for key, rows in index.items())
+        self._stats.count('full_scans')
+        return _group_rows(self._rows.values(), column_names)
+
+    def aggregate(self, column_names, count=True, sum=(), min=(), max=()):
+        """Compute aggregates of each group of rows, see `group_by`.
+
+        Rows without aggregated column (or with `None` in it) are skipped
+        by that aggregate. Aggregate without any values is `None`.
+
+        :optimization:
+            Existing index on `column_names` is used (counts are taken
+            from it without visiting rows), otherwise aggregates are
+            computed in one pass over rows (index is not created).
+
+        :param column_names: Column names to group on.
+        :param count: Count rows of each group.
+        :param sum: Column names to be summed.
+        :param min: Column names to find minimal values of.
+        :param max: Column names to find maximal values of.
+        :type column_names:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+        :type count: `bool`.
+        :type sum: `tuple`, `list` or `str`. (as `column_names`)
+        :type min: `tuple`, `list` or `str`. (as `column_names`)
+        :type max: `tuple`, `list` or `str`. (as `column_names`)
+
+        :returns: Column values -> ``{'count': rows, 'sum': {column: sum},
+            'min': {column: value}, 'max': {column: value}}``
+            (only requested aggregates are included).
+        :rtype: `dict` of `tuple` -> `dict`.
+        """
+        column_names = _tupleize_cols(column_names)
+        aggregates = [(name, _tupleize_cols(agg_cols)) for name, agg_cols
+            in (('sum', sum), ('min', min), ('max', max)) if agg_cols]
+        def new_result():
+            result = dict((name, dict.fromkeys(agg_cols)) for name, agg_cols in aggregates)
+            if count:
+                result['count'] = 0
+            return result
+        results = dict()
+        index_names, order = _sort_columns(column_names)
+        index = self._index_get(index_names)
+        if index is not None:
+            restore = order and _sort_columns(order)[1] # inverse of `order`
+            for key, rows in index.items():
+                result = results[_reorder(key, restore)] = new_result()
+                if count:
+                    result['count'] = len(rows)
+                if aggregates:
+                    for row in rows:
+                        _aggregate_row(result, row, aggregates)
+            return results
+        self._stats.count('full_scans')
+        for row in self._rows.values():
+            key = _row_key(row, column_names)
+            if key is None:
+                continue
+            result = results.get(key)
+            if result is None:
+                result = results[key] = new_result()
+            if count:
+                result['count'] += 1
+            _aggregate_row(result, row, aggregates)
+        return results
+
+    def stats(self):
+        """Return counters of table operations.
+
+        - ``index_builds``, ``index_build_seconds`` - indexes built,
+          because they were needed by lookups;
+        - ``index_builds_by_columns`` - number of builds per column names;
+        - ``index_rebuilds`` - indexes rebuilt after replacing rows;
+        - ``index_evictions`` - indexes dropped, see `DBSchema.set_index_budget`;
+        - ``index_hits``, ``index_misses`` - index lookups (not) finding rows;
+        - ``full_scans`` - lookups, that checked all rows;
+        - ``derefs``, ``broken_references`` - dereferences to this table.
+
+        :rtype: `dict`.
+        """
+        return self._stats.as_dict()
+
+    def memory_usage(self):
+        """Return approximate memory used by the table in bytes.
+
+        Sizes are computed by `sys.getsizeof` of rows and objects reachable
+        from them (each object counted once), so it takes time proportional
+        to the number of stored values. Values of index keys are shared
+        with rows, so they are counted only in ``rows``.
+
+        - ``rows`` - row store (rows and their values);
+        - ``indexes``, ``sorted_indexes`` - column names -> size of index;
+        - ``total`` - sum of all above.
+
+        :rtype: `dict`.
+        """
+        seen = set([id(self), id(self._schema)])
+        usage = {
+            'rows': _deep_sizeof([getattr(self, name) for name in self._row_store], seen),
+            'indexes': dict((column_names, _index_memory_usage(index, self, column_names))
+                for column_names, index in list(self._indexes.items())),
+            'sorted_indexes': dict((column_names, _index_memory_usage(index))
+                for column_names, index in list(self._sorted_indexes.items())),
+        }
+        usage['total'] = (usage['rows'] + sum(usage['indexes'].values())
+            + sum(usage['sorted_indexes'].values()))
+        return usage
+
+    def where(self, **conditions):
+        """Start lazy query of rows, see `_Query.where`.
+
+        >>> s.items.where(owner_id=1).where(name__in=['chair']).select('name')
+        """
+        return _Query(self).where(**conditions)
+
+    def find_rows_many(self, column_names, column_values_list, skip_index=False):
+        """Find rows for each of many column value filters.
+
+        Same as calling `find_rows` for each item of `column_values_list`,
+        but normalization and index check is done once
+        (and only one table scan is done if `skip_index`).
+
+        :param column_values_list: Column values to be searched.
+        :type column_values_list:
+            iterable of `tuple`, `list` or `str`. (see `find_rows`)
+        :returns: Found rows, in order of `column_values_list`.
+        :rtype: `list` of `set` of `_DBRow`.
+        """
+        column_names, order = _sort_columns(_tupleize_cols(column_names))
+        keys = [_reorder(values if type(values) is tuple else _tupleize_cols(values), order)
+            for values in column_values_list]
+        if skip_index:
+            self._stats.count('full_scans')
+            found = dict((key, set()) for key in keys)
+            for row in self._rows.values():
+                row_key = _row_key(row, column_names)
+                if row_key in found:
+                    found[row_key].add(row)
+            return [found[key] for key in keys]
+        lookup = self._index_lookup(column_names)
+        found = [lookup(key) for key in keys]
+        misses = found.count(None)
+        self._stats.count('index_hits', len(found) - misses)
+        self._stats.count('index_misses', misses)
+        return [rows if rows is not None else set() for rows in found]
+
+    def prepare_finder(self, column_names):
+        """Return function: column values -> rows, same as `find_rows`.
+
+        :optimization:
+            Faster alternative to `find_rows` for many lookups with the same
+            columns. Column names are normalized once, existing index is used
+            directly (other cases are passed to `find_rows`).
+            Index is looked up on each call, because it can be rebuilt
+            or evicted (see `DBSchema.set_index_budget`).
+
+        :param column_names: Column names to be filtered on.
+        :type column_names:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+        :returns: Function: column values (`tuple` or `list`,
+            corresponding to `column_names`) -> `set` of rows.
+        """
+        column_names, order = _sort_columns(_tupleize_cols(column_names))
+        indexes, stats = self._indexes, self._stats
+        def find_rows(column_values):
+            key = column_values if type(column_values) is tuple else tuple(column_values)
+            if order is not None:
+                key = _reorder(key, order)
+            index = indexes.get(column_names)
+            if index is None:
+                return self.find_rows(column_names, key)
+            if self._index_budget is not None:
+                self._index_budget.touch(self, False, column_names)
+            rows = index.get(key)
+            if rows is None:
+                stats.count('index_misses')
+                return set()
+            stats.count('index_hits')
+            return rows
+        return find_rows
+
+    def find_range(self, column_names, low=None, high=None,
+            include_low=True, include_high=True):
+        """Find rows, whose column values are in range.
+
+        Column values are compared as tuples (in order of `column_names`).
+        Bounds can be shorter than `column_names`, then only that many
+        leading columns are compared (e.g. ``high=('b',)`` includes ``('b', 5)``).
+
+        :optimization:
+            Sorted index is created before searching, if it does not exist yet.
+
+        :param column_names: Column names to be compared.
+        :param low: Lowest column values. `None` - no lower bound.
+        :param high: Highest column values. `None` - no upper bound.
+        :param include_low: Is range closed at `low`.
+        :param include_high: Is range closed at `high`.
+
+        :type column_names:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+        :type low: `None`, `tuple`, `list` or `str`. (as `column_names`)
+        :type high: `None`, `tuple`, `list` or `str`. (as `column_names`)
+
+        :returns: Rows ordered by column values.
+        :rtype: `list` of `_DBRow`.
+        """
+        column_names = _tupleize_cols(column_names)
+        if low is not None:
+            low = _tupleize_cols(low)
+        if high is not None:
+            high = _tupleize_cols(high)
+        sorted_index = self._sorted_index(column_names)
+        return sorted_index.find_range(low, high, include_low, include_high)
+
+    def find_prefix(self, column_names, prefix):
+        """Find rows, whose first column value starts with `prefix`.
+
+        :optimization: As in `find_range`.
+
+        :param column_names:
+            Column names. First column is compared with `prefix`,
+            others only define order of returned rows.
+        :param prefix: Beginning of string value.
+        :type column_names:
+            `tuple`, `list` or `str`. (`str` is processed by `str.split`)
+        :type prefix: `str`.
+
+        :returns: Rows ordered by column values.
+        :rtype: `list` of `_DBRow`.
+        """
+        column_names = _tupleize_cols(column_names)
+        return self._sorted_index(column_names).find_prefix(prefix)
+
     def _walking_find_rows(self, column_names, column_values):
         """Find rows by iterating through all elements."""
+        column_values = tuple(column_values)
         return set([row for row in self._rows.values()
-            if list(row.column_values(column_names)) == list(column_values)])
+            if _row_key(row, column_names) == column_values])
+
+    def _index_ensure(self, column_names):
+        """Return index, create it if it does not exist yet."""
+        index = self._index_get(column_names)
+        if index is None:
+            return self._index_build(column_names)
+        return index
+
+    def _index_lookup(self, column_names):
+        """Return function: column values -> `set` of rows, `None` if not found.
+
+        Index on `column_names` (sorted) is used, or existing index on more
+        columns, that starts with `column_names`, or new index is created.
+        """
+        index = self._index_get(column_names)
+        if index is None:
+            lookup = self._index_composite(column_names)
+            if lookup is not None:
+                return lookup
+            index = self._index_build(column_names)
+        return index.get
+
+    def _index_composite(self, column_names):
+        """Return lookup function (see `_index_lookup`) using the smallest
+        hash index, whose leading columns are `column_names`,
+        `None` if there is no such index (see `_index_prefix_lookup`).
+        """
+        prefix_len = len(column_names)
+        candidates = [(index_names, index)
+            for index_names, index in list(self._indexes.items())
+            if len(index_names) > prefix_len and index_names[:prefix_len] == column_names
+                and isinstance(index, dict)]
+        for index_names, index in sorted(candidates, key=lambda c: len(c[0])):
+            lookup = self._index_prefix_lookup(index_names, index, prefix_len)
+            if lookup is not None:
+                if self._index_budget is not None:
+                    self._index_budget.touch(self, False, index_names)
+                return lookup
+        return None
+
+    def _index_prefix_lookup(self, index_names, index, prefix_len):
+        """Return lookup function (see `_index_lookup`) of leading columns of index.
+
+        Keys of the index are grouped by their first `prefix_len` values,
+        these groups are kept and updated by `_index_add_row`.
+
+        Index can not be used (`None` is returned), if some rows are not in it
+        (they lack some of its columns), as such rows can still match the
+        leading columns. Then `_prefix_maps` of the index is `None`.
+        """
+        prefix_maps = self._prefix_maps.get(index_names, dict())
+        if prefix_maps is None:
+            return None
+        if index_names not in self._prefix_maps:
+            indexed = sum([len(rows) for rows in list(index.values())])
+            if indexed < len(self._rows):
+                self._prefix_maps[index_names] = None
+                return None
+            self._prefix_maps[index_names] = prefix_maps
+        prefix_map = prefix_maps.get(prefix_len)
+        if prefix_map is None:
+            prefix_map = dict() # leading values -> keys of the index
+            for key in list(index):
+                prefix = key[:prefix_len]
+                if prefix not in prefix_map:
+                    prefix_map[prefix] = list()
+                prefix_map[prefix].append(key)
+            prefix_maps[prefix_len] = prefix_map
+            if self._index_budget is not None:
+                self._index_budget.resized(self)
+        def lookup(prefix):
+            keys = prefix_map.get(prefix)
+            if keys is None:
+                return None
+            found = set()
+            for key in keys:
+                found.update(index[key])
+            return found
+        return lookup
+
+    def _index_get(self, column_names):
+        """Return index, if it exists, otherwise `None`."""
+        index = self._indexes.get(column_names)
+        if index is not None and self._index_budget is not None:
+            self._index_budget.touch(self, False, column_names)
+        return index
+
+    def _index_build(self, column_names):
+        """Create index, that is needed by lookup, and return it."""
+        started = time.time()
+        self._prefix_maps.pop(column_names, None)
+        index = self._index_create(column_names)
+        self._stats.count_build(column_names, time.time() - started)
+        if self._index_budget is not None:
+            self._index_budget.add(self, False, column_names)
+            self._index_budget.enforce()
+        return index
 
     def _index_create(self, column_names):
-        """Create index, to make finding rows more efficient."""
-        new_index = dict()
-        for row in self._rows.values():
-            idx_key = row.column_values(column_names)
-            if idx_key not in new_index:
-                new_index[idx_key] = set()
-            new_index[idx_key].add(row)
+        """Create index, to make finding rows more efficient, and return it."""
+        new_index = _group_rows(self._rows.values(), column_names)
         self._indexes[column_names] = new_index
+        return new_index
+
+    def _index_add_row(self, row, sorted_indexes=True):
+        """Add new row to all existing indexes (instead of dropping them)."""
+        for column_names, index in list(self._indexes.items()):
+            idx_key = _row_key(row, column_names)
+            if idx_key is None:
+                if column_names in self._prefix_maps:
+                    self._prefix_maps[column_names] = None # see `_index_prefix_lookup`
+                continue
+            if idx_key not in index:
+                index[idx_key] = set()
+                for prefix_len, prefix_map in (self._prefix_maps.get(column_names) or {}).items():
+                    prefix = idx_key[:prefix_len]
+                    if prefix not in prefix_map:
+                        prefix_map[prefix] = list()
+                    prefix_map[prefix].append(idx_key)
+            index[idx_key].add(row)
+        if sorted_indexes:
+            for sorted_index in list(self._sorted_indexes.values()):
+                sorted_index.add_rows([row])
+
+    def _sorted_index(self, column_names):
+        """Return sorted index, create it if it does not exist yet."""
+        sorted_index = self._sorted_indexes.get(column_names)
+        if sorted_index is None:
+            return self._sorted_index_build(column_names)
+        if self._index_budget is not None:
+            self._index_budget.touch(self, True, column_names)
+        return sorted_index
+
+    def _sorted_index_build(self, column_names):
+        """Create sorted index, that is needed by lookup, and return it."""
+        started = time.time()
+        sorted_index = self._sorted_index_create(column_names)
+        self._stats.count_build(column_names, time.time() - started)
+        if self._index_budget is not None:
+            self._index_budget.add(self, True, column_names)
+            self._index_budget.enforce()
+        return sorted_index
+
+    def _sorted_index_create(self, column_names):
+        sorted_index = _SortedIndex(column_names, self._rows.values())
+        self._sorted_indexes[column_names] = sorted_index
+        return sorted_index
 
     def _index_find_rows(self, column_names, column_values):
-        """Find rows by using index."""
-        index = self._indexes[column_names]
-        if column_values in index:
-            return index[tuple(column_values)]
+        """Find rows by using index (see `_index_lookup`)."""
+        rows = self._index_lookup(column_names)(tuple(column_values))
+        if rows is not None:
+            self._stats.count('index_hits')
+            return rows
         else:
+            self._stats.count('index_misses')
             return set()
 
     def _index_exists(self, column_names):
         """Check if index exists."""
         return column_names in self._indexes
 
+    def _write_snapshot(self, f, with_indexes, write_map=None):
+        """Write rows (and indexes) to `f`, return header entry of the table.
+
+        Each row is marshalled tuple (column number, value, ...),
+        followed by table of row offsets, pk -> row number map and indexes.
+
+        :param write_map: Function: (`f`, `dict`) -> positions of written
+            pk -> row number map and index (key -> `tuple` of row numbers),
+            default is `_write_marshalled`.
+        """
+        write_map = write_map or _write_marshalled
+        layout = dict() # column name -> column number
+        row_numbers = dict() # row -> row number
+        keys = dict() # pk value -> row number
+        offsets = [f.tell()]
+        for pk_value, row in self._rows.items():
+            record = list()
+            for name, value in row._plain_columns().items():
+                if name not in layout:
+                    layout[name] = len(layout)
+                record.extend((layout[name], value))
+            f.write(marshal.dumps(tuple(record)))
+            offsets.append(f.tell())
+            row_numbers[row] = keys[pk_value] = len(keys)
+        offsets_pos = f.tell()
+        f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        entry = {
+            'name': self._name,
+            'pk': self._pk,
+            'columns': tuple(sorted(layout, key=layout.get)),
+            'offsets': offsets_pos,
+            'rows': len(keys),
+            'keys': write_map(f, keys),
+            'indexes': dict(),
+            'refs': self._refs,
+            'intern': self._intern,
+        }
+        if with_indexes:
+            for column_names, index in list(self._indexes.items()):
+                entry['indexes'][column_names] = write_map(f, dict(
+                    (key, tuple([row_numbers[row] for row in rows]))
+                    for key, rows in index.items()))
+        return entry
+
     def _index_clear_all(self):
         for index in self._indexes.values():
             index.clear()
         self._indexes.clear()
+        self._prefix_maps.clear()
+        self._sorted_indexes.clear()
+
+
+class _SortedIndex(object):
+    """Rows ordered by values of some columns.
+
+    Used by `_DBTable.find_range` and `_DBTable.find_prefix`.
+    """
+
+    def __init__(self, column_names, rows):
+        self._column_names = column_names
+        self._keys = list() # sorted column values
+        self._rows = list() # rows corresponding to `_keys`
+        self.add_rows(rows)
+
+    def add_rows(self, rows):
+        """Add rows, keeping order."""
+        column_names = self._column_names
+        new_pairs = [(_row_key(row, column_names), row) for row in rows]
+        new_pairs = [(key, row) for key, row in new_pairs if key is not None]
+        if len(new_pairs) == 1:
+            key, row = new_pairs[0]
+            pos = _bisect(self._keys, key, right=True)
+            self._keys.insert(pos, key)
+            self._rows.insert(pos, row)
+        elif new_pairs:
+            # Sorting is close to linear, because existing pairs are ordered.
+            pairs = sorted(list(zip(self._keys, self._rows)) + new_pairs,
+                key=itemgetter(0))
+            self._keys = [key for key, row in pairs]
+            self._rows = [row for key, row in pairs]
+
+    def find_range(self, low, high, include_low, include_high):
+        """Return rows with keys in range, see `_DBTable.find_range`."""
+        start, end = self.range_positions(low, high, include_low, include_high)
+        return self._rows[start:end]
+
+    def range_positions(self, low, high, include_low, include_high):
+        """Return (start, end) positions of rows with keys in range."""
+        start = 0 if low is None else _bisect(self._keys, low, not include_low)
+        end = len(self._keys) if high is None else _bisect(self._keys, high, include_high)
+        return start, max(start, end)
+
+    def find_prefix(self, prefix):
+        """Return rows, whose first key value starts with `prefix`."""
+        keys = self._keys
+        start = end = _bisect(keys, (prefix,), right=False)
+        while (end < len(keys) and isinstance(keys[end][0], _basestring)
+                and keys[end][0].startswith(prefix)):
+            end += 1
+        return self._rows[start:end]
+
+
+class _CompactTable(_DBTable):
+    """_DBTable, that stores each row as a tuple of plain values.
+
+    All rows share one column layout (column name -> position in tuple),
+    so per-cell `_DBValue` objects are not kept in memory.
+    """
+
+    _row_store = ('_rows', '_intern_pools', '_layout')
+
+    def __init__(self, parent_schema, name, pk):
+        super(_CompactTable, self).__init__(parent_schema, name, pk)
+        self._layout = dict() # column name -> position in row tuple
+
+    def _make_row(self, value_dict):
+        """Construct `_CompactRow` (not yet added to the table)."""
+        layout = self._layout
+        for name in value_dict:
+            if name not in layout:
+                layout[name] = len(layout)
+        values = [_MISSING] * len(layout)
+        for name, val in value_dict.items():
+            values[layout[name]] = val
+        return _CompactRow(self, tuple(values))
+
+
+class _ColumnarTable(_DBTable):
+    """_DBTable, that stores each column in a contiguous array.
+
+    See `_Column` for the storage of values.
+    Full scans (`find_rows` with `skip_index`) compare whole columns at once,
+    vectorized with `numpy` when it is installed.
+    """
+
+    _row_store = ('_rows', '_intern_pools', '_layout', '_positions')
+
+    def __init__(self, parent_schema, name, pk):
+        super(_ColumnarTable, self).__init__(parent_schema, name, pk)
+        self._layout = dict() # column name -> _Column
+        self._positions = list() # position -> _ColumnarRow
+
+    def _make_row(self, value_dict):
+        """Append values to columns and return `_ColumnarRow` view of them.
+
+        Row is not yet added to the table, but its position is taken
+        even if it is never added (e.g. duplicate pk).
+        """
+        pos = len(self._positions)
+        layout = self._layout
+        for name in value_dict:
+            if name not in layout:
+                layout[name] = _Column(pos)
+        for name, column in layout.items():
+            column.append(value_dict.get(name, _MISSING))
+        new_row = _ColumnarRow(self, pos)
+        self._positions.append(new_row)
+        return new_row
+
+    def _walking_find_rows(self, column_names, column_values):
+        """Find rows by comparing whole columns."""
+        columns = [self._layout.get(name) for name in column_names]
+        if (not self._positions or len(columns) != len(column_values)
+                or any(column is None for column in columns)):
+            return set()
+        if numpy is not None:
+            mask = numpy.ones(len(self._positions), dtype=bool)
+            for column, value in zip(columns, column_values):
+                mask &= column.mask(value)
+            positions = numpy.flatnonzero(mask).tolist()
+        else:
+            positions = None
+            for column, value in zip(columns, column_values):
+                positions = column.positions(value, positions)
+        found = [self._positions[pos] for pos in positions]
+        if len(self._positions) != len(self._rows):
+            # Skip positions, that were not added or were replaced.
+            found = [row for row in found if self._rows.get(row._pk_value) is row]
+        return set(found)
+
+
+class _SnapshotTable(_DBTable):
+    """_DBTable, whose rows are decoded from snapshot on first access.
+
+    See `DBSchema.open_snapshot`.
+    New rows can be added as usual.
+    """
+
+    def __init__(self, parent_schema, name, pk, buf, entry):
+        """Construct DBTable from snapshot.
+
+        :param buf: Snapshot contents (`mmap` or `str`).
+        :param entry: Header entry written by `_DBTable._write_snapshot`.
+        """
+        super(_SnapshotTable, self).__init__(parent_schema, name, pk)
+        self._rows = _SnapshotRows(self, buf, entry)
+        self._snapshot_indexes = entry['indexes']
+
+    def _index_create(self, column_names):
+        """Create index, reusing index saved in snapshot if possible."""
+        if column_names not in self._snapshot_indexes or self._rows._added:
+            return super(_SnapshotTable, self)._index_create(column_names)
+        row_at = self._rows._row_at
+        saved_index = _read_marshalled(self._rows._buf,
+            self._snapshot_indexes[column_names])
+        new_index = dict((key, set([row_at(number) for number in row_numbers]))
+            for key, row_numbers in saved_index.items())
+        self._indexes[column_names] = new_index
+        return new_index
+
+
+class _SnapshotRows(MutableMapping):
+    """pk value -> row mapping of `_SnapshotTable`.
+
+    Rows are decoded from snapshot buffer on first access and cached.
+    Rows added after opening the snapshot are kept in plain dict.
+    """
+
+    def __init__(self, table, buf, entry):
+        self._table = table
+        self._buf = buf
+        self._columns = entry['columns']
+        self._offsets = entry['offsets']
+        self._keys_pos = entry['keys']
+        self._keys = None # pk value -> row number, read on first use
+        self._decoded = dict() # row number -> row
+        self._added = dict() # pk value -> row
+
+    def __getitem__(self, pk_value):
+        if pk_value in self._added:
+            return self._added[pk_value]
+        return self._row_at(self._snapshot_keys()[pk_value])
+
+    def __setitem__(self, pk_value, row):
+        self._added[pk_value] = row
+
+    def __delitem__(self, pk_value):
+        raise TypeError('Rows can not be deleted')
+
+    def __contains__(self, pk_value):
+        return pk_value in self._added or pk_value in self._snapshot_keys()
+
+    def __iter__(self):
+        for pk_value in self._snapshot_keys():
+            yield pk_value
+        for pk_value in self._added:
+            if pk_value not in self._snapshot_keys():
+                yield pk_value
+
+    def __len__(self):
+        return len(self._snapshot_keys()) + len(
+            [k for k in self._added if k not in self._snapshot_keys()])
+
+    def iteritems(self):
+        for pk_value, number in self._snapshot_keys().items():
+            if pk_value not in self._added:
+                yield pk_value, self._row_at(number)
+        for item in self._added.items():
+            yield item
+
+    def items(self): return list(self.iteritems())
+    def values(self): return [row for pk_value, row in self.iteritems()]
+
+    def _snapshot_keys(self):
+        if self._keys is None:
+            self._keys = _read_marshalled(self._buf, self._keys_pos)
+        return self._keys
+
+    def _row_at(self, number):
+        """Return row by its number in snapshot."""
+        if number not in self._decoded:
+            start, end = struct.unpack_from('<QQ', self._buf, self._offsets + 8 * number)
+            record = marshal.loads(self._buf[start:end])
+            columns = self._columns
+            value_dict = dict(
+                (columns[record[i]], record[i + 1]) for i in range(0, len(record), 2))
+            if self._table._intern is not None:
+                value_dict = self._table._intern_values(value_dict)
+            row = self._table._make_row(value_dict)
+            # Other thread could have decoded the same row meanwhile.
+            return self._decoded.setdefault(number, row)
+        return self._decoded[number]
+
+
+class _FrozenTable(_SnapshotTable):
+    """Read-only _DBTable, that keeps rows and indexes only in snapshot buffer.
+
+    See `DBSchema.freeze`.
+    Rows are decoded on each access (into `_FrozenRow`) and are not cached.
+    Rows are found by pk and by saved indexes (see `_FrozenIndex`) through
+    hash tables in the buffer, so they are not decoded into dicts.
+    Other indexes are built as usual.
+    """
+
+    _row_store = ('_buf', '_intern_pools', '_layout')
+
+    def __init__(self, parent_schema, name, pk, buf, entry):
+        super(_FrozenTable, self).__init__(parent_schema, name, pk, buf, entry)
+        self._buf = buf
+        self._rows = _FrozenRows(self, buf, entry)
+        self._layout = dict((name, pos) for pos, name in enumerate(entry['columns']))
+        for column_names in self._snapshot_indexes:
+            self._index_create(column_names)
+
+    def add_row(self, value_dict):
+        raise TypeError('Table {} is frozen'.format(self._name))
+
+    def add_rows(self, value_dicts, on_duplicate='raise'):
+        raise TypeError('Table {} is frozen'.format(self._name))
+
+    def _index_create(self, column_names):
+        """Create index, reusing index saved in snapshot if possible."""
+        if column_names not in self._snapshot_indexes:
+            return _DBTable._index_create(self, column_names)
+        new_index = _FrozenIndex(self._rows, _FrozenHashTable(
+            self._buf, self._snapshot_indexes[column_names]), column_names)
+        self._indexes[column_names] = new_index
+        return new_index
+
+    def _index_clear_all(self):
+        # Saved indexes are kept, they take no memory outside of the buffer.
+        for column_names in list(self._indexes):
+            if column_names not in self._snapshot_indexes:
+                del self._indexes[column_names]
+        self._prefix_maps.clear()
+        self._sorted_indexes.clear()
+
+
+class _FrozenRows(Mapping):
+    """pk value -> row mapping of `_FrozenTable`."""
+
+    def __init__(self, table, buf, entry):
+        self._table = table
+        self._buf = buf
+        self._columns = entry['columns']
+        self._offsets = entry['offsets']
+        self._count = entry['rows']
+        self._keys = _FrozenHashTable(buf, entry['keys'])
+
+    def __getitem__(self, pk_value):
+        row = self._find(pk_value)
+        if row is None:
+            raise KeyError(pk_value)
+        return row
+
+    def __contains__(self, pk_value): return self._find(pk_value) is not None
+    def __len__(self): return self._count
+
+    def __iter__(self):
+        for number in range(self._count):
+            yield self._row_at(number)._pk_value
+
+    def iteritems(self):
+        for number in range(self._count):
+            row = self._row_at(number)
+            yield row._pk_value, row
+
+    def items(self): return list(self.iteritems())
+    def values(self): return [self._row_at(number) for number in range(self._count)]
+
+    def _find(self, pk_value):
+        """Return row by pk value, `None` if not found."""
+        for numbers in self._keys.candidates(pk_value):
+            row = self._row_at(numbers[0])
+            if row._pk_value == pk_value:
+                return row
+        return None
+
+    def _row_at(self, number):
+        """Return new `_FrozenRow` by its number in snapshot."""
+        start, end = struct.unpack_from('<QQ', self._buf, self._offsets + 8 * number)
+        record = marshal.loads(self._buf[start:end])
+        values = [_MISSING] * len(self._columns)
+        for i in range(0, len(record), 2):
+            values[record[i]] = record[i + 1]
+        return _FrozenRow(self._table, tuple(values), number)
+
+
+class _FrozenIndex(Mapping):
+    """Index of `_FrozenTable`: column values -> `set` of rows.
+
+    Row numbers are found in `_FrozenHashTable`, rows are decoded
+    on each lookup.
+    """
+
+    def __init__(self, rows, hash_table, column_names):
+        """
+        :param rows: `_FrozenRows` of the table.
+        :param hash_table: `_FrozenHashTable` of column values -> row numbers.
+        """
+        self._rows = rows
+        self._hash_table = hash_table
+        self._column_names = column_names
+
+    def __getitem__(self, key):
+        rows = self._find(key)
+        if rows is None:
+            raise KeyError(key)
+        return rows
+
+    def __contains__(self, key): return self._find(key) is not None
+    def __len__(self): return len(self._hash_table)
+
+    def __iter__(self):
+        for key, rows in self.items():
+            yield key
+
+    def items(self):
+        row_at = self._rows._row_at
+        result = list()
+        for numbers in self._hash_table.groups():
+            rows = set([row_at(number) for number in numbers])
+            result.append((_row_key(next(iter(rows)), self._column_names), rows))
+        return result
+
+    def _find(self, key):
+        """Return `set` of rows by column values, `None` if not found."""
+        row_at = self._rows._row_at
+        for numbers in self._hash_table.candidates(key):
+            first = row_at(numbers[0])
+            if _row_key(first, self._column_names) == key:
+                return set([first] + [row_at(number) for number in numbers[1:]])
+        return None
+
+
+class _FrozenHashTable(object):
+    """Hash table written by `_write_hash_table`, searched in the buffer.
+
+    Slots are (hash of key, start, count) of groups of row numbers.
+    Keys are not stored, so candidates must be checked by caller.
+    """
+
+    _SLOT = struct.Struct('<qQQ')
+
+    def __init__(self, buf, position):
+        self._buf = buf
+        self._slots, self._size, self._numbers, self._len = position
+
+    def __len__(self): return self._len
+
+    def candidates(self, key):
+        """Yield `tuple` of row numbers of each key with the same hash as `key`.
+
+        :raises TypeError: Key is not hashable.
+        """
+        key_hash = hash(key)
+        slot = key_hash % self._size
+        while True:
+            slot_hash, start, count = self._SLOT.unpack_from(
+                self._buf, self._slots + self._SLOT.size * slot)
+            if not count:
+                return
+            if slot_hash == key_hash:
+                yield self._group(start, count)
+            slot = (slot + 1) % self._size
+
+    def groups(self):
+        """Yield `tuple` of row numbers of each key."""
+        for slot in range(self._size):
+            slot_hash, start, count = self._SLOT.unpack_from(
+                self._buf, self._slots + self._SLOT.size * slot)
+            if count:
+                yield self._group(start, count)
+
+    def _group(self, start, count):
+        return struct.unpack_from('<{}Q'.format(count), self._buf, self._numbers + 8 * start)
+
+
+class _SQLiteTable(_CompactTable):
+    """_DBTable, that keeps rows in SQLite database, for tables larger than memory.
+
+    Rows are stored pickled, see `_SQLiteRows`. Lookups by pk
+    (`__getitem__`, `_DBValue.deref`) and `find_rows` (`find_refs`)
+    are SQL queries, indexes are SQL indexes kept in database file.
+    Decoded rows are cached (see ``sqlite_cache_rows`` of `DBSchema`),
+    row, that was dropped from the cache, is decoded again as new object.
+    Sorted indexes, `scan`, `group_by` and `join` still need
+    (some) rows in memory. Pk values must be `int`, `float` or strings.
+    """
+
+    def __init__(self, parent_schema, name, pk):
+        super(_SQLiteTable, self).__init__(parent_schema, name, pk)
+        if parent_schema is None:
+            db, cache_rows = _sqlite_connect(''), 100000
+        else:
+            db = parent_schema._sqlite_connection()
+            cache_rows = parent_schema._sqlite_cache_rows
+        self._rows = _SQLiteRows(self, db, cache_rows)
+
+    def _index_create(self, column_names):
+        """Create SQL index, return its `_SQLiteIndex`."""
+        self._rows._create_index(column_names)
+        new_index = _SQLiteIndex(self._rows, column_names)
+        self._indexes[column_names] = new_index
+        return new_index
+
+    def _index_add_row(self, row, sorted_indexes=True):
+        """Add new row to sorted indexes (SQL indexes are kept by SQLite)."""
+        if sorted_indexes:
+            for sorted_index in list(self._sorted_indexes.values()):
+                sorted_index.add_rows([row])
+
+    def _walking_find_rows(self, column_names, column_values):
+        """Find rows by SQL query, that does not use index."""
+        return set(self._rows._select(column_names, tuple(column_values)))
+
+    def _write_snapshot(self, f, with_indexes, write_map=None):
+        """Write rows to `f`, SQL indexes are not saved."""
+        return super(_SQLiteTable, self)._write_snapshot(f, False, write_map)
+
+    def _index_clear_all(self):
+        # SQL indexes stay in database, `_index_create` reuses them.
+        self._indexes.clear()
+        self._prefix_maps.clear()
+        self._sorted_indexes.clear()
+
+
+class _SQLiteRows(MutableMapping):
+    """pk value -> row mapping of `_SQLiteTable`, stored in SQLite table.
+
+    Each SQL row has id, pickled columns of the row and copies of column
+    values in SQL columns (one per column name, added when first seen).
+    Value, that SQLite can not store (see `_sql_value`), is NULL in its SQL
+    column, so queries give candidate rows, that are checked in Python.
+    Existing SQL table with the same name is replaced.
+    """
+
+    def __init__(self, table, db, cache_rows):
+        self._table = table
+        self._db = db
+        self._sql_table = _sql_name('dblike', table._name)
+        self._columns = dict() # column name -> SQL column name
+        self._cache = OrderedDict() # SQL row id -> row, least recently used first
+        self._cache_rows = cache_rows
+        self._cache_lock = threading.Lock()
+        self._pk_columns = _tupleize_cols(table._pk)
+        db.execute('DROP TABLE IF EXISTS ' + self._sql_table)
+        db.execute('CREATE TABLE {} (_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            '_data BLOB)'.format(self._sql_table))
+        self._create_index(self._pk_columns, unique=True)
+
+    def __getitem__(self, pk_value):
+        found = self._select(self._pk_columns, pk_value)
+        if not found:
+            raise KeyError(pk_value)
+        return found[0]
+
+    def __setitem__(self, pk_value, row):
+        self.update({pk_value: row})
+
+    def __delitem__(self, pk_value):
+        raise TypeError('Rows can not be deleted')
+
+    def __contains__(self, pk_value):
+        return bool(self._select(self._pk_columns, pk_value))
+
+    def __iter__(self):
+        for row in self.itervalues():
+            yield row._pk_value
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM ' + self._sql_table).fetchone()[0]
+
+    def itervalues(self):
+        cursor = self._db.execute('SELECT _id, _data FROM ' + self._sql_table)
+        for row_id, data in cursor:
+            yield self._decode(row_id, data)
+
+    def iteritems(self):
+        for row in self.itervalues():
+            yield row._pk_value, row
+
+    def items(self): return list(self.iteritems())
+    def values(self): return list(self.itervalues())
+
+    def update(self, new_rows):
+        """Insert (or replace) rows in one transaction.
+
+        :type new_rows: `dict` of pk value -> row.
+        """
+        records = list()
+        for pk_value, row in new_rows.items():
+            if any(_sql_value(value) in (None, _MISSING) for value in pk_value):
+                raise TypeError('Unsupported pk value of sqlite storage: {!r}'.format(
+                    pk_value))
+            columns = row._plain_columns()
+            self._add_columns(columns)
+            records.append(columns)
+        names = list(self._columns)
+        insert = 'INSERT OR REPLACE INTO {} (_data, {}) VALUES (?{})'.format(
+            self._sql_table, ', '.join([self._columns[name] for name in names]),
+            ', ?' * len(names))
+        self._db.executemany(insert, ([sqlite3.Binary(pickle.dumps(columns, 2))]
+            + [_sql_param(columns.get(name)) for name in names]
+            for columns in records))
+        self._db.commit()
+
+    def _select(self, column_names, column_values):
+        """Return rows, whose column values are equal to `column_values`."""
+        sql_values = [_sql_value(value) for value in column_values]
+        if len(sql_values) != len(column_names):
+            return list()
+        if _MISSING in sql_values:
+            candidates = self.itervalues() # SQL column does not have the value
+        elif not all(name in self._columns for name in column_names):
+            return list()
+        else:
+            conditions = [self._columns[name] + (' IS NULL' if value is None else ' = ?')
+                for name, value in zip(column_names, sql_values)]
+            cursor = self._db.execute('SELECT _id, _data FROM {} WHERE {}'.format(
+                self._sql_table, ' AND '.join(conditions)),
+                [value for value in sql_values if value is not None])
+            candidates = [self._decode(row_id, data) for row_id, data in cursor]
+        return [row for row in candidates
+            if _row_key(row, column_names) == column_values]
+
+    def _decode(self, row_id, data):
+        """Return row from cache, or unpickle it (and cache it)."""
+        with self._cache_lock:
+            row = self._cache.pop(row_id, None)
+            if row is None:
+                value_dict = pickle.loads(bytes(data))
+                if self._table._intern is not None:
+                    value_dict = self._table._intern_values(value_dict)
+                row = self._table._make_row(value_dict)
+            self._cache[row_id] = row
+            if len(self._cache) > self._cache_rows:
+                self._cache.popitem(last=False)
+            return row
+
+    def _add_columns(self, column_names):
+        """Add SQL columns for column names, that were not seen yet."""
+        for name in column_names:
+            if name not in self._columns:
+                sql_column = '"c{}"'.format(len(self._columns))
+                self._db.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    self._sql_table, sql_column))
+                self._columns[name] = sql_column
+
+    def _create_index(self, column_names, unique=False):
+        self._add_columns(column_names)
+        self._db.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            'UNIQUE ' if unique else '',
+            _sql_name('dblike-index', self._table._name, *column_names),
+            self._sql_table, ', '.join([self._columns[name] for name in column_names])))
+        self._db.commit()
+
+
+class _SQLiteIndex(Mapping):
+    """Index of `_SQLiteTable` (column values -> `set` of rows).
+
+    Lookups are SQL queries, iteration groups all rows in memory.
+    Use `get` to find rows by one query (instead of ``in`` and ``[]``).
+    """
+
+    def __init__(self, rows, column_names):
+        self._rows = rows
+        self._column_names = column_names
+
+    def __getitem__(self, key):
+        found = self._find(key)
+        if not found:
+            raise KeyError(key)
+        return set(found)
+
+    def __contains__(self, key): return bool(self._find(key))
+
+    def get(self, key, default=None):
+        found = self._find(key)
+        return set(found) if found else default
+
+    def __iter__(self): return iter(self._groups())
+    def __len__(self): return len(self._groups())
+    def items(self): return list(self._groups().items())
+
+    def _find(self, key):
+        try:
+            return self._rows._select(self._column_names, tuple(key))
+        except TypeError:
+            return list() # not a tuple of values
+
+    def _groups(self):
+        return _group_rows(self._rows.itervalues(), self._column_names)
+
+
+class _Query(object):
+    """Lazy query of `_DBTable` rows.
+
+    Query is evaluated each time it is iterated.
+
+    :optimization:
+        Of existing indexes (hash and sorted ones), the one, that gives
+        the least candidate rows, is used. Other conditions are checked
+        on candidate rows. Without usable index all rows are checked.
+        Indexes are never created by query.
+    """
+
+    def __init__(self, table, conditions=(), column_names=None):
+        self._table = table
+        self._conditions = tuple(conditions) # (column name, operator, operand)
+        self._column_names = column_names
 
+    def where(self, **conditions):
+        """Return query with additional conditions (joined by ``and``).
 
-class _DBRow(object):
+        Condition is ``column=value`` or ``column__operator=value``,
+        where operator is one of: ``eq``, ``ne``, ``lt``, ``le``, ``gt``,
+        ``ge``, ``in`` (value is iterable). Rows without the column
+        do not match any condition.
+        """
+        new_conditions = list(self._conditions)
+        for key, operand in sorted(conditions.items()):
+            name, _, operator_name = key.rpartition('__')
+            if operator_name not in _QUERY_OPERATORS:
+                name, operator_name = key, 'eq'
+            if operator_name == 'in':
+                try:
+                    operand = frozenset(operand)
+                except TypeError:
+                    operand = tuple(operand) # unhashable values
+            new_conditions.append((name, operator_name, operand))
+        return _Query(self._table, new_conditions, self._column_names)
+
+    def select(self, *column_names):
+        """Return query, that yields column values instead of rows.
+
+        :param column_names: Column names, see `_DBRow.column_values`.
+        """
+        column_names = tuple([name for names in column_names
+            for name in _tupleize_cols(names)])
+        return _Query(self._table, self._conditions, column_names)
+
+    def __iter__(self):
+        with self._table._lock.reading():
+            candidates, used = self._plan()
+            if self._table._lock is not _NO_LOCK:
+                # Rows must not be iterated, while other thread adds them.
+                candidates = [list(rows) for rows in candidates]
+        residual = [c for i, c in enumerate(self._conditions) if i not in used]
+        column_names = self._column_names
+        for rows in candidates:
+            for row in rows:
+                if all(_query_match(row, c) for c in residual):
+                    yield row if column_names is None else row.column_values(column_names)
+
+    def _plan(self):
+        """Choose index for the query.
+
+        :returns: (iterable of candidate row iterables,
+            positions of conditions that are satisfied by candidates)
+        """
+        table = self._table
+        points = dict() # column name -> (condition position, values)
+        bounds = dict() # column name -> {operator: (condition position, operand)}
+        for i, (name, operator_name, operand) in enumerate(self._conditions):
+            if operator_name in ('eq', 'in') and name not in points:
+                points[name] = (i, [operand] if operator_name == 'eq' else operand)
+            if operator_name in ('eq', 'lt', 'le', 'gt', 'ge'):
+                bounds.setdefault(name, dict()).setdefault(operator_name, (i, operand))
+        best = None # (number of candidates, candidates, used conditions)
+        for column_names, index in list(table._indexes.items()):
+            covered = 0 # leading columns of index, that have conditions
+            while covered < len(column_names) and column_names[covered] in points:
+                covered += 1
+            if covered == len(column_names):
+                lookup = index.get
+            elif covered and isinstance(index, dict):
+                lookup = table._index_prefix_lookup(column_names, index, covered)
+                if lookup is None:
+                    continue # index lacks some rows
+            else:
+                continue
+            try:
+                keys = set(product(*[points[name][1] for name in column_names[:covered]]))
+                buckets = [bucket for bucket in map(lookup, keys) if bucket is not None]
+            except TypeError:
+                continue # unhashable values
+            count = sum(len(bucket) for bucket in buckets)
+            if best is None or count < best[0]:
+                best = (count, buckets,
+                    set(points[name][0] for name in column_names[:covered]),
+                    (False, column_names))
+        for column_names, sorted_index in list(table._sorted_indexes.items()):
+            name_bounds = bounds.get(column_names[0])
+            if not name_bounds:
+                continue
+            if len(column_names) > 1 and len(sorted_index._keys) < len(table._rows):
+                continue # rows lacking later columns are not in the index
+            low = high = None
+            include_low = include_high = True
+            used = set()
+            if 'eq' in name_bounds:
+                i, operand = name_bounds['eq']
+                low = high = (operand,)
+                used.add(i)
+            else:
+                for operator_name in ('gt', 'ge'):
+                    if operator_name in name_bounds and low is None:
+                        i, operand = name_bounds[operator_name]
+                        low, include_low = (operand,), operator_name == 'ge'
+                        used.add(i)
+                for operator_name in ('lt', 'le'):
+                    if operator_name in name_bounds and high is None:
+                        i, operand = name_bounds[operator_name]
+                        high, include_high = (operand,), operator_name == 'le'
+                        used.add(i)
+            start, end = sorted_index.range_positions(
+                low, high, include_low, include_high)
+            if best is None or end - start < best[0]:
+                best = (end - start, [sorted_index._rows[start:end]], used,
+                    (True, column_names))
+        if best is None:
+            table._stats.count('full_scans')
+            return [table._rows.values()], set()
+        if table._index_budget is not None:
+            table._index_budget.touch(table, *best[3])
+        return best[1], best[2]
+
+
+class _LockedTableMixin(object):
+    """Makes `_DBTable` (or its subclass) safe for use from many threads.
+
+    Used by `DBSchema` created with ``thread_safe=True``.
+    Public methods hold read lock (many readers at once) or write lock
+    (one writer, no readers) of the table.
+    Index, that is needed by many readers at once, is built only once.
+    Methods, that return iterators, return iterators over copies.
+    Found rows are returned in copies of index sets.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_LockedTableMixin, self).__init__(*args, **kwargs)
+        self._lock = _RWLock()
+        self._index_lock = threading.Lock()
+
+    def iteritems(self):
+        with self._lock.reading():
+            return iter(list(super(_LockedTableMixin, self).iteritems()))
+
+    def values(self):
+        with self._lock.reading():
+            return list(super(_LockedTableMixin, self).values())
+
+    def find_rows(self, *args, **kwargs):
+        with self._lock.reading():
+            return set(super(_LockedTableMixin, self).find_rows(*args, **kwargs))
+
+    def find_rows_many(self, *args, **kwargs):
+        with self._lock.reading():
+            return [set(rows) for rows in
+                super(_LockedTableMixin, self).find_rows_many(*args, **kwargs)]
+
+    def group_by(self, column_names):
+        with self._lock.reading():
+            return dict((key, set(rows)) for key, rows in
+                super(_LockedTableMixin, self).group_by(column_names).items())
+
+    def row_getter(self):
+        get_row = super(_LockedTableMixin, self).row_getter()
+        lock = self._lock
+        def locked_get_row(row_id):
+            with lock.reading():
+                return get_row(row_id)
+        return locked_get_row
+
+    def prepare_finder(self, column_names):
+        find_rows = super(_LockedTableMixin, self).prepare_finder(column_names)
+        lock = self._lock
+        def locked_find_rows(column_values):
+            with lock.reading():
+                return set(find_rows(column_values))
+        return locked_find_rows
+
+    def _index_build(self, column_names):
+        with self._index_lock:
+            index = self._indexes.get(column_names)
+            if index is not None:
+                return index # built by other thread meanwhile
+            return super(_LockedTableMixin, self)._index_build(column_names)
+
+    def _sorted_index_build(self, column_names):
+        with self._index_lock:
+            sorted_index = self._sorted_indexes.get(column_names)
+            if sorted_index is not None:
+                return sorted_index
+            return super(_LockedTableMixin, self)._sorted_index_build(column_names)
+
+
+def _locked_method(name, lock_mode):
+    """Wrap `_DBTable` method for `_LockedTableMixin`."""
+    def method(self, *args, **kwargs):
+        with getattr(self._lock, lock_mode)():
+            return getattr(super(_LockedTableMixin, self), name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for _name in ('__contains__', '__getitem__', 'get_many', 'find_range',
+        'find_prefix', 'scan', 'aggregate', 'memory_usage'):
+    setattr(_LockedTableMixin, _name, _locked_method(_name, 'reading'))
+for _name in ('add_row', 'add_rows'):
+    setattr(_LockedTableMixin, _name, _locked_method(_name, 'writing'))
+del _name
+
+
+# Thread-safe subclasses of table classes, see `DBSchema._table_class`.
+_LOCKED_TABLE_CLASSES = dict()
+
+
+class _RWLock(object):
+    """Readers/writer lock.
+
+    Many threads can hold read lock at once, or one thread can hold write lock.
+    Thread, that waits for write lock, blocks new readers,
+    except threads, that already hold read (or write) lock.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None # thread, that holds write lock
+        self._writers_waiting = 0
+        self._local = threading.local() # .depth - nested read locks of thread
+
+    @contextmanager
+    def reading(self):
+        depth = getattr(self._local, 'depth', 0)
+        nested = depth or self._writer is threading.current_thread()
+        if not nested:
+            with self._cond:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if not nested:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.current_thread()
+        if self._writer is me:
+            yield # nested write lock
+            return
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+
+class _NoLock(object):
+    """Lock of tables, that are not thread-safe. Does nothing."""
+
+    def __enter__(self): return self
+    def __exit__(self, *exc_info): return False
+    def reading(self): return self
+    def writing(self): return self
+
+
+_NO_LOCK = _NoLock()
+
+
+class _TableStats(object):
+    """Counters of table operations, see `_DBTable.stats`."""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.hook = None # see `DBSchema.set_stats_hook`
+        self.counters = dict.fromkeys(('index_builds', 'index_build_seconds',
+            'index_rebuilds', 'index_evictions', 'index_hits', 'index_misses', 'full_scans',
+            'derefs', 'broken_references'), 0)
+        self.builds_by_columns = dict()
+
+    def count(self, name, amount=1):
+        if amount:
+            self.counters[name] += amount
+            if self.hook is not None:
+                self.hook(self.table_name, name, amount)
+
+    def count_build(self, column_names, seconds):
+        self.builds_by_columns[column_names] = (
+            self.builds_by_columns.get(column_names, 0) + 1)
+        self.count('index_builds')
+        self.count('index_build_seconds', seconds)
+
+    def as_dict(self):
+        result = dict(self.counters)
+        result['index_builds_by_columns'] = dict(self.builds_by_columns)
+        return result
+
+
+class _IndexBudget(object):
+    """Memory limit of indexes of `DBSchema`, see `DBSchema.set_index_budget`.
+
+    Indexes are identified by (table, is sorted, column names).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._clock = count()
+        self._entries = dict() # index id -> [last use, size in bytes]
+        self._resized = set() # tables, whose index sizes should be measured
+
+    def add(self, table, is_sorted, column_names):
+        """Start tracking index, that was just built."""
+        index = _budget_index(table, is_sorted, column_names)
+        if index is not None:
+            self._entries[(table, is_sorted, column_names)] = [
+                next(self._clock), _budget_index_size(table, is_sorted, column_names, index)]
+
+    def touch(self, table, is_sorted, column_names):
+        """Mark index as used."""
+        entry = self._entries.get((table, is_sorted, column_names))
+        if entry is not None:
+            entry[0] = next(self._clock)
+
+    def resized(self, table):
+        """Note that rows were added to indexes of `table`."""
+        self._resized.add(table)
+
+    def enforce(self):
+        """Drop least recently used indexes, until they fit into the limit.
+
+        The most recently used index is never dropped.
+        """
+        with self._lock:
+            resized, self._resized = self._resized, set()
+            entries = self._entries
+            for index_id, entry in list(entries.items()):
+                index = _budget_index(*index_id)
+                if index is None:
+                    del entries[index_id] # dropped by `_index_clear_all`
+                elif index_id[0] in resized:
+                    entry[1] = _budget_index_size(*(index_id + (index,)))
+            total = sum([entry[1] for entry in entries.values()])
+            by_use = sorted(entries, key=lambda index_id: entries[index_id][0])
+            for table, is_sorted, column_names in by_use[:-1]:
+                if total <= self.max_bytes:
+                    break
+                indexes = table._sorted_indexes if is_sorted else table._indexes
+                indexes.pop(column_names, None)
+                if not is_sorted:
+                    table._prefix_maps.pop(column_names, None)
+                total -= entries.pop((table, is_sorted, column_names))[1]
+                table._stats.count('index_evictions')
+
+
+class _BaseRow(object):
+    """Methods shared by `_DBRow` and rows kept by other storages.
+
+    Has no `__dict__`, so that `__slots__` of subclasses are effective.
+    Subclasses define `_schema`, `_pk`, `_columns` and `__getattr__`.
+    """
+
+    __slots__ = ()
+
+    def __repr__(self): return '_DBRow({0._schema!r}, {0._pk!r}, {0._columns!r})'.format(self)
+
+    def find_refs(self, table_name, column_names):
+        """Find rows in other table, that refer to this row.
+
+        :param table_name: Table to be search.
+        :param column_names:
+            Columns to be compared for match with `self._pk_value`.
+        """
+        column_names = _tupleize_cols(column_names)
+        table = self._schema[table_name]
+        return table.find_rows(column_names, self._pk_value)
+
+    def column_values(self, column_names):
+        """Return plain column values (without _DBValue wrappers)."""
+        column_names = _tupleize_cols(column_names)
+        return tuple([self._columns[name].value for name in column_names])
+
+    def _plain_columns(self):
+        """Return names->value map of columns (without _DBValue wrappers)."""
+        return dict((name, value.value) for name, value in self._columns.items())
+
+    @property
+    def _pk_value(self):
+        """Get primary key column values
+
+        Should be called only from :class:`_DBTable`.
+        """
+        return self.column_values(self._pk)
+
+
+class _DBRow(_BaseRow):
     """Contains dict of _DBValue.
 
     Public methods of this class, belong to the interface of the module,
@@ -249,31 +2388,207 @@ class _DBRow(object):
             self._columns[i] = _DBValue(self._schema, self, i, val)
 
     def __getattr__(self, column_name): return self._columns[column_name]
-    def __repr__(self): return '_DBRow({0._schema!r}, {0._pk!r}, {0._columns!r})'.format(self)
 
-    def find_refs(self, table_name, column_names):
-        """Find rows in other table, that refer to this row.
 
-        :param table_name: Table to be search.
-        :param column_names:
-            Columns to be compared for match with `self._pk_value`.
-        """
-        column_names = _tupleize_cols(column_names)
-        table = self._schema[table_name]
-        return table.find_rows(column_names, self._pk_value)
+class _LazyRow(_BaseRow):
+    """_DBRow, whose plain values are kept by the table.
+
+    `_DBValue` wrappers are created on each column access,
+    so they should not be compared by identity.
+    Subclasses define `_plain_value`.
+    """
+
+    __slots__ = ('_up',)
+
+    def __getattr__(self, column_name):
+        return _DBValue(self._up._schema, self, column_name,
+            self._plain_value(column_name))
+
+    @property
+    def _schema(self):
+        return self._up._schema
+
+    @property
+    def _pk(self):
+        return self._up._pk
+
+    @property
+    def _columns(self):
+        """Column values wrapped into `_DBValue` (as in `_DBRow`)."""
+        schema = self._up._schema
+        return dict((name, _DBValue(schema, self, name, value))
+            for name, value in self._plain_columns().items())
+
+    def _plain_columns(self):
+        columns = dict()
+        for name in list(self._up._layout):
+            try:
+                columns[name] = self._plain_value(name)
+            except KeyError:
+                pass # column is missing in this row
+        return columns
 
     def column_values(self, column_names):
         """Return plain column values (without _DBValue wrappers)."""
         column_names = _tupleize_cols(column_names)
-        return tuple([self._columns[name].value for name in column_names])
+        return tuple([self._plain_value(name) for name in column_names])
 
-    @property
-    def _pk_value(self):
-        """Get primary key column values
+    def _plain_value(self, column_name):
+        """Return plain value of one column.
 
-        Should be called only from :class:`_DBTable`.
+        :raises KeyError: Row does not have such column.
         """
-        return self.column_values(self._pk)
+        raise NotImplementedError
+
+
+class _CompactRow(_LazyRow):
+    """_DBRow, that keeps values in a tuple laid out by `_CompactTable`."""
+
+    __slots__ = ('_values',)
+
+    def __init__(self, table, values):
+        self._up = table
+        self._values = values
+
+    def _plain_columns(self):
+        values = self._values
+        return dict((name, values[pos]) for name, pos in list(self._up._layout.items())
+            if pos < len(values) and values[pos] is not _MISSING)
+
+    def _plain_value(self, column_name):
+        pos = self._up._layout[column_name]
+        if pos >= len(self._values) or self._values[pos] is _MISSING:
+            raise KeyError(column_name)
+        return self._values[pos]
+
+
+class _FrozenRow(_CompactRow):
+    """_CompactRow decoded from `_FrozenTable`.
+
+    Rows are not cached by the table, so rows are equal,
+    when they have the same number in the same table (not by identity).
+    """
+
+    __slots__ = ('_number',)
+
+    def __init__(self, table, values, number):
+        super(_FrozenRow, self).__init__(table, values)
+        self._number = number
+
+    def __eq__(self, other):
+        return (type(other) is type(self) and other._up is self._up
+            and other._number == self._number)
+
+    def __ne__(self, other): return not self == other
+    def __hash__(self): return hash((id(self._up), self._number))
+
+
+class _ColumnarRow(_LazyRow):
+    """_DBRow, that is a view of one position in `_ColumnarTable`."""
+
+    __slots__ = ('_pos',)
+
+    def __init__(self, table, pos):
+        self._up = table
+        self._pos = pos
+
+    def _plain_value(self, column_name):
+        value = self._up._layout[column_name][self._pos]
+        if value is _MISSING:
+            raise KeyError(column_name)
+        return value
+
+
+class _Column(object):
+    """Values of one `_ColumnarTable` column.
+
+    `int` and `float` values are kept in `array.array`.
+    Column, that gets any other value, is converted to dictionary encoding:
+    list of distinct values and `array.array` of their codes.
+    """
+
+    def __init__(self, size):
+        """Construct column for table, that already has `size` rows.
+
+        These rows do not have the column, so it starts dictionary encoded.
+        """
+        self._array = None # set only while column is not dictionary encoded
+        self._codes = array('l')
+        self._values = list() # code -> value
+        self._lookup = dict() # value -> code (of first value of same type)
+        if size:
+            self._codes.extend([self._encode(_MISSING)] * size)
+
+    def __len__(self):
+        values = self._array
+        return len(self._codes) if values is None else len(values)
+
+    def __getitem__(self, pos):
+        values = self._array # read once, as it is reset by `_dictionary_encode`
+        if values is None:
+            return self._values[self._codes[pos]]
+        else:
+            return values[pos]
+
+    def append(self, value):
+        if not len(self) and type(value) in _ARRAY_TYPECODES:
+            self._array = array(_ARRAY_TYPECODES[type(value)])
+        if self._array is not None:
+            if _ARRAY_TYPECODES.get(type(value)) == self._array.typecode:
+                try:
+                    self._array.append(value)
+                    return
+                except OverflowError:
+                    pass
+            self._dictionary_encode()
+        self._codes.append(self._encode(value))
+
+    def mask(self, value):
+        """Return `numpy` bool array, that marks positions equal to `value`."""
+        if self._array is not None:
+            if type(value) in _ARRAY_TYPECODES or type(value) is bool:
+                return numpy.frombuffer(self._array, self._array.typecode) == value
+            return numpy.array([v == value for v in self._array], dtype=bool)
+        codes = numpy.frombuffer(self._codes, self._codes.typecode)
+        return numpy.isin(codes, list(self._matching_codes(value)))
+
+    def positions(self, value, candidates=None):
+        """Return positions (out of `candidates`) with values equal to `value`."""
+        if candidates is not None:
+            return [pos for pos in candidates if self[pos] == value]
+        if self._array is not None:
+            return [pos for pos, v in enumerate(self._array) if v == value]
+        codes = self._matching_codes(value)
+        if len(codes) == 1:
+            code, = codes
+            return [pos for pos, c in enumerate(self._codes) if c == code]
+        return [pos for pos, c in enumerate(self._codes) if c in codes]
+
+    def _matching_codes(self, value):
+        """Return codes of distinct values, that are equal to `value`."""
+        return set([code for code, v in enumerate(self._values)
+            if v is not _MISSING and v == value])
+
+    def _encode(self, value):
+        """Return code of the value, adding it to dictionary if needed."""
+        try:
+            code = self._lookup.get(value)
+        except TypeError:
+            code = None # unhashable value is not shared
+        if code is not None and type(self._values[code]) is type(value):
+            return code
+        code = len(self._values)
+        self._values.append(value)
+        try:
+            self._lookup.setdefault(value, code)
+        except TypeError:
+            pass
+        return code
+
+    def _dictionary_encode(self):
+        # Codes are complete before `_array` is reset for lock-free readers.
+        self._codes = array('l', [self._encode(v) for v in self._array])
+        self._array = None
 
 
 class _DBValue(object):
@@ -306,13 +2621,421 @@ class _DBValue(object):
         """
         assert self.value
         table = self._schema[table_name]
+        table._stats.count('derefs')
         try:
             return table[self.value]
         except RowKeyError as e:
+            table._stats.count('broken_references')
             src_3id = (self._up._up._name, self._up._pk, self._up._pk_value)
             raise BrokenReferenceError(src_3id, self._colname, e._trg)
 
 
+# First bytes of file written by `DBSchema.save_snapshot`.
+_SNAPSHOT_MAGIC = b'DBLIKE-SNAPSHOT-1\n'
+
+
+def _write_marshalled(f, obj):
+    """Write marshalled `obj` to `f`, return its (start, end) positions."""
+    start = f.tell()
+    f.write(marshal.dumps(obj))
+    return start, f.tell()
+
+
+def _write_hash_table(f, mapping):
+    """Write `mapping` for `_FrozenHashTable`, return its position.
+
+    Open addressing with linear probing, at most half of slots are used.
+
+    :param mapping: Key -> row number or `tuple` of row numbers.
+    """
+    size = 2 * len(mapping) + 1
+    slots = [(0, 0, 0)] * size
+    numbers = list()
+    for key, value in mapping.items():
+        group = value if isinstance(value, tuple) else (value,)
+        key_hash = hash(key)
+        slot = key_hash % size
+        while slots[slot][2]:
+            slot = (slot + 1) % size
+        slots[slot] = (key_hash, len(numbers), len(group))
+        numbers.extend(group)
+    slots_pos = f.tell()
+    for slot in slots:
+        f.write(_FrozenHashTable._SLOT.pack(*slot))
+    numbers_pos = f.tell()
+    f.write(struct.pack('<{}Q'.format(len(numbers)), *numbers))
+    return slots_pos, size, numbers_pos, len(mapping)
+
+
+def _read_marshalled(buf, positions):
+    """Opposite of `_write_marshalled`."""
+    start, end = positions
+    return marshal.loads(buf[start:end])
+
+
+try:
+    _basestring = basestring
+except NameError:
+    _basestring = str # Python 3 compatibility.
+
+
+# Placeholder for columns that are absent in row with shared layout.
+_MISSING = object()
+
+
+# Table implementations selectable by `TableDef.storage`.
+_TABLE_STORAGES = {
+    None: _DBTable,
+    'dict': _DBTable,
+    'compact': _CompactTable,
+    'columnar': _ColumnarTable,
+    'sqlite': _SQLiteTable,
+}
+
+
+# Types of values, that `_Column` keeps in `array.array` (type -> typecode).
+_ARRAY_TYPECODES = {int: 'l', float: 'd'}
+
+
+# Types of values, that `_SQLiteTable` copies into SQL columns.
+try:
+    _SQL_INT_TYPES = (int, long, bool)
+    _SQL_TYPES = _SQL_INT_TYPES + (float, str, unicode)
+except NameError:
+    _SQL_INT_TYPES = (int, bool) # Python 3 compatibility.
+    _SQL_TYPES = _SQL_INT_TYPES + (float, str, bytes)
+
+
+def _iter_xml_rows(source, row_tags):
+    """Parse XML incrementally and yield rows for `DBSchema.load_xml`.
+
+    :param row_tags: Tags of elements, that are rows.
+    :returns: iterator of (tag, value_dict).
+    """
+    path = list() # elements, that are started, but not yet ended
+    open_rows = 0 # row elements in `path`
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem)
+            if elem.tag in row_tags:
+                open_rows += 1
+            continue
+        path.pop()
+        if elem.tag in row_tags:
+            open_rows -= 1
+            value_dict = dict(elem.attrib)
+            for child in elem:
+                if child.tag not in row_tags: # nested rows are not columns
+                    value_dict[child.tag] = child.text
+            yield elem.tag, value_dict
+        if not open_rows:
+            # Element is not part of any row, so it is not needed anymore.
+            elem.clear()
+            if path:
+                path[-1].remove(elem)
+
+
+def _bisect(keys, bound, right):
+    """Find position of `bound` in sorted list of tuples.
+
+    Only as many leading values of keys are compared, as there are in `bound`.
+
+    :param right: Return position after (instead of before) equal keys.
+    """
+    bound_len = len(bound)
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key = keys[mid][:bound_len]
+        if key < bound or (right and key == bound):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _parse_shard(task):
+    """Parse one shard for `DBSchema.load_parallel` (runs in worker process).
+
+    :param task: (parse function, shard)
+    :returns: list of (table name, (layouts, rows)), where layouts are
+        tuples of column names and rows are tuples
+        (layout number, column values...).
+    """
+    parse, shard = task
+    batches = list() # (table name, (layouts, rows)), in order of appearance
+    tables = dict() # table name -> (layouts, layout numbers, rows)
+    for table_name, value_dict in parse(shard):
+        if table_name not in tables:
+            tables[table_name] = (list(), dict(), list())
+            batches.append((table_name, (tables[table_name][0], tables[table_name][2])))
+        layouts, numbers, rows = tables[table_name]
+        columns = tuple(value_dict)
+        if columns not in numbers:
+            numbers[columns] = len(layouts)
+            layouts.append(columns)
+        rows.append((numbers[columns],) + tuple(value_dict.values()))
+    return batches
+
+
+# (rows, predicate) of running `_DBTable.scan`, inherited by forked workers.
+_scan_states = dict() # token -> (rows, predicate)
+_scan_tokens = count()
+
+
+def _scan_chunk(chunk):
+    """Check rows of `_scan_states` (runs in worker process).
+
+    :param chunk: (token of scan, start, stop positions of rows to be checked).
+    :returns: Positions of rows, for which predicate is true.
+    """
+    token, start, stop = chunk
+    rows, predicate = _scan_states[token]
+    return [pos for pos in range(start, stop) if predicate(rows[pos])]
+
+
+def _join_probe_right(left, left_cols, right, right_cols, outer):
+    """`DBSchema.join` using index of right table."""
+    find_rows = _join_finder(right, right_cols)
+    for left_row in left.values():
+        right_rows = find_rows(_row_key(left_row, left_cols))
+        if right_rows:
+            for right_row in right_rows:
+                yield left_row, right_row
+        elif outer:
+            yield left_row, None
+
+
+def _join_probe_left(left, left_cols, right, right_cols, outer):
+    """`DBSchema.join` using index of left table."""
+    find_rows = _join_finder(left, left_cols)
+    matched_keys = set()
+    for right_row in right.values():
+        key = _row_key(right_row, right_cols)
+        left_rows = find_rows(key)
+        if left_rows:
+            if outer:
+                matched_keys.add(key)
+            for left_row in left_rows:
+                yield left_row, right_row
+    if outer:
+        # Rows lacking the columns are not in the index, but are unmatched.
+        for left_row in left.values():
+            key = _row_key(left_row, left_cols)
+            if key is None or key not in matched_keys:
+                yield left_row, None
+
+
+def _join_finder(table, column_names):
+    """Return function: column values -> rows (`None` if not found) for join.
+
+    Index is built under read lock of the table and rows are copied
+    for thread-safe tables, as the join is iterated outside of the lock.
+    """
+    with table._lock.reading():
+        index = table._index_ensure(column_names)
+    lock = table._lock
+    if lock is _NO_LOCK:
+        return lambda key: None if key is None else index.get(key)
+    def find_rows(key):
+        if key is None:
+            return None
+        with lock.reading():
+            rows = index.get(key)
+            return None if rows is None else list(rows)
+    return find_rows
+
+
+def _budget_index(table, is_sorted, column_names):
+    """Return index tracked by `_IndexBudget`, `None` if it was dropped."""
+    indexes = table._sorted_indexes if is_sorted else table._indexes
+    return indexes.get(column_names)
+
+
+def _budget_index_size(table, is_sorted, column_names, index):
+    """Return size of index tracked by `_IndexBudget`, see `_index_memory_usage`."""
+    if is_sorted:
+        return _index_memory_usage(index)
+    return _index_memory_usage(index, table, column_names)
+
+
+def _index_memory_usage(index, table=None, column_names=None):
+    """Return approximate size of index in bytes (without rows and key values).
+
+    Size of hash index includes its `_DBTable._prefix_maps`,
+    if `table` and `column_names` of the index are given.
+    """
+    prefix_maps = table is not None and table._prefix_maps.get(column_names)
+    if prefix_maps:
+        return _index_memory_usage(index) + sum([sys.getsizeof(prefix_map)
+            + sum([sys.getsizeof(prefix) + sys.getsizeof(keys)
+                for prefix, keys in prefix_map.items()])
+            for prefix_map in prefix_maps.values()])
+    if isinstance(index, _SQLiteIndex):
+        return sys.getsizeof(index) # kept by SQLite
+    if isinstance(index, _FrozenIndex):
+        return sys.getsizeof(index) # kept in buffer of `_FrozenTable`
+    if isinstance(index, _SortedIndex):
+        return (sys.getsizeof(index._keys) + sys.getsizeof(index._rows)
+            + sum([sys.getsizeof(key) for key in index._keys]))
+    return sys.getsizeof(index) + sum(
+        [sys.getsizeof(key) + sys.getsizeof(rows) for key, rows in index.items()])
+
+
+def _deep_sizeof(objects, seen):
+    """Return size of objects and of all objects reachable from them in bytes.
+
+    Objects referred to by `gc.get_referents` are followed: contents
+    of containers, `__dict__` and `__slots__`. (Unlike ``obj.__dict__``,
+    it does not create empty `__dict__` of objects, that have none yet.)
+    Objects, whose ids are in `seen`, are not counted (nor followed)
+    and counted objects are added to `seen`.
+    """
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if not isinstance(obj, (array, _basestring, int, float)):
+            stack.extend(gc.get_referents(obj))
+    return size
+
+
+def _group_rows(rows, column_names):
+    """Return column values -> `set` of rows (rows lacking columns are skipped)."""
+    groups = dict()
+    for row in rows:
+        key = _row_key(row, column_names)
+        if key is None:
+            continue
+        if key not in groups:
+            groups[key] = set()
+        groups[key].add(row)
+    return groups
+
+
+def _aggregate_row(result, row, aggregates):
+    """Add values of the row into `_DBTable.aggregate` result of its group.
+
+    :param aggregates: (aggregate name, column names) pairs.
+    """
+    for name, column_names in aggregates:
+        values = result[name]
+        for column_name in column_names:
+            key = _row_key(row, (column_name,))
+            if key is None or key[0] is None:
+                continue
+            value, old = key[0], values[column_name]
+            if (old is None or (name == 'min' and value < old)
+                    or (name == 'max' and value > old)):
+                values[column_name] = value
+            elif name == 'sum':
+                values[column_name] = old + value
+
+
+def _sqlite_connect(path):
+    """Open SQLite database for `_SQLiteTable`.
+
+    Tables are rebuilt by each run, so journal and syncing are disabled.
+    """
+    if sqlite3 is None:
+        raise ImportError('sqlite3 module is needed by sqlite storage')
+    db = sqlite3.connect(path, check_same_thread=False)
+    if str is bytes:
+        db.text_factory = str # Python 2: allow binding of 8-bit strings.
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    return db
+
+
+def _sql_name(*parts):
+    """Return quoted SQL identifier made of `parts`."""
+    return '"{}"'.format(':'.join(parts).replace('"', '""'))
+
+
+def _sql_value(value):
+    """Return value as stored in SQL column, `_MISSING` if SQLite can not store it."""
+    if value is None or (type(value) in _SQL_TYPES
+            and not (type(value) in _SQL_INT_TYPES and not -2 ** 63 <= value < 2 ** 63)):
+        return value
+    return _MISSING
+
+
+def _sql_param(value):
+    """Return SQL column parameter of the value (NULL if SQLite can not store it)."""
+    value = _sql_value(value)
+    return None if value is _MISSING else value
+
+
+def _sort_columns(column_names):
+    """Return column names sorted (as in keys of `_DBTable._indexes`)
+    and their positions in `column_names` (`None` if they are already sorted).
+    """
+    order = sorted(range(len(column_names)), key=column_names.__getitem__)
+    if order == list(range(len(order))):
+        return column_names, None
+    return tuple([column_names[i] for i in order]), order
+
+
+def _reorder(values, order):
+    """Order values by positions from `_sort_columns`.
+
+    Values are not changed, if `order` is `None` or has different length.
+    """
+    if order is None or len(values) != len(order):
+        return values
+    return tuple([values[i] for i in order])
+
+
+def _loader_rows(loader, table_name):
+    """Return `value_dict` of each row from loader, see `DBSchema._load_table`."""
+    if isinstance(loader, (list, tuple)):
+        return chain.from_iterable(_loader_rows(shard, table_name) for shard in loader)
+    if callable(loader):
+        return loader()
+    snapshot = DBSchema.open_snapshot(loader)
+    return (row._plain_columns() for row in snapshot[table_name].values())
+
+
+def _row_key(row, column_names):
+    """Return column values of the row, `None` if row lacks some column.
+
+    Rows without the columns are not indexed and do not match any values.
+    """
+    try:
+        return row.column_values(column_names)
+    except KeyError:
+        return None
+
+
+# Operators of `_Query.where` conditions.
+_QUERY_OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'in': lambda value, operand: value in operand,
+}
+
+
+def _query_match(row, condition):
+    """Check if row matches `_Query` condition."""
+    name, operator_name, operand = condition
+    key = _row_key(row, (name,))
+    return key is not None and _QUERY_OPERATORS[operator_name](key[0], operand)
+
+
+def _check_missing(missing):
+    """Validate `missing` argument of `get_many` like methods."""
+    if missing not in ('raise', 'none', 'skip'):
+        raise ValueError('Unknown missing: {!r}'.format(missing))
+
+
 def _tupleize_cols(cols):
     """Modules standard preprocessing of column names or values.
 
@@ -320,10 +3043,6 @@ def _tupleize_cols(cols):
         These can be passed as space delimited string or as iterable.
     :returns: tuple of columns (either names or values).
     """
-    try:
-        _basestring = basestring
-    except NameError:
-        _basestring = str # Python 3 compatibility.
     if isinstance(cols, _basestring):
         return tuple(cols.split())
     else:
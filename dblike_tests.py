@@ -1,6 +1,16 @@
+import gc
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import dblike
 from dblike import (TableDef, DBSchema, _DBTable, _DBRow, _DBValue,
-    _tupleize_cols,
+    _CompactTable, _CompactRow, _ColumnarTable, _ColumnarRow, _Column,
+    _SnapshotTable, _FrozenTable, _FrozenIndex, _SQLiteTable, _SQLiteRows, _LockedTableMixin, _RWLock,
+    _tupleize_cols, _MISSING,
     DuplicateRowException, RowKeyError, BrokenReferenceError)
 
 
@@ -10,11 +20,15 @@ class DBLikeTestCase(unittest.TestCase):
     (tests that are not isolated to separate classes)
     """
 
+    storage = None
+    thread_safe = False
+
     def setUp(self):
         """Define simple schema for query testing purposes"""
-        s = DBSchema(schema_def=[
-                    TableDef(name='items', pk='item_id'),
-                    TableDef(name='owners', pk='owner_id')
+        s = DBSchema(thread_safe=self.thread_safe, schema_def=[
+                    TableDef(name='items', pk='item_id', storage=self.storage,
+                        refs={'owner_id': 'owners'}),
+                    TableDef(name='owners', pk='owner_id', storage=self.storage)
                 ])
         s.owners.add_row({'owner_id':1, 'owner_name':'Tom'})
         s.items.add_row({'item_id':1, 'name':'chair', 'owner_id':1})
@@ -36,6 +50,102 @@ class DBLikeTestCase(unittest.TestCase):
             "BrokenReferenceError(src=('items', 'item_id', (3,)),"+
             " col=owner_id, trg=('owners', 'owner_id', (2,)))")
 
+    def test_check_references(self):
+        s = self.s
+        s.items.add_row({'item_id':4, 'name':'free', 'owner_id':None})
+        errors = s.check_references()
+        self.assertEqual([str(e) for e in errors], [
+            "BrokenReferenceError(src=('items', 'item_id', (3,)),"+
+            " col=owner_id, trg=('owners', 'owner_id', (2,)))"])
+
+    def test_refs_index(self):
+        s = self.s
+        self.assertTrue(s.items._index_exists(('owner_id',)))
+        self.assertEqual(s.items._refs, {('owner_id',): 'owners'})
+
+    def test_deref_many(self):
+        s = self.s
+        values = [s.items[3].owner_id, s.items[1].owner_id, s.items[2].owner_id]
+        with self.assertRaises(BrokenReferenceError):
+            s.deref_many(values, 'owners')
+        self.assertEqual(s.deref_many(values, 'owners', missing='none'),
+            [None, s.owners[1], s.owners[1]])
+        self.assertEqual(s.deref_many(values, 'owners', missing='skip'),
+            [s.owners[1], s.owners[1]])
+
+    def test_prepare_finder(self):
+        s = self.s
+        find = s.items.prepare_finder('name owner_id')
+        self.assertEqual(find(('house', 1)), set([s.items[2]]))
+        self.assertEqual(find(['chair', 1]), set([s.items[1]]))
+        self.assertEqual(find(('house', 2)), set())
+        s.items._index_clear_all() # index is rebuilt when needed
+        self.assertEqual(find(('mixer', 2)), set([s.items[3]]))
+        s.items.add_row({'item_id':4, 'name':'house', 'owner_id':1})
+        self.assertEqual(find(('house', 1)), set([s.items[2], s.items[4]]))
+        stats = s.items.stats()
+        self.assertEqual((stats['index_hits'], stats['index_misses']), (4, 1))
+
+    def test_row_getter(self):
+        s = self.s
+        get_row = s.items.row_getter()
+        self.assertTrue(get_row(2) is s.items[2])
+        self.assertEqual(get_row(3).name.value, 'mixer')
+        with self.assertRaises(RowKeyError) as cm:
+            get_row(5)
+        self.assertEqual(str(cm.exception), 'RowKeyError(items, item_id, (5,))')
+
+    def test_join(self):
+        s = self.s
+        pairs = lambda it: sorted((l.item_id.value, r and r.owner_name.value) for l, r in it)
+        # Index on bigger table already exists, so it is reused.
+        s.items.find_rows('owner_id', [1])
+        self.assertEqual(pairs(s.join('items', 'owner_id', 'owners', 'owner_id')),
+            [(1, 'Tom'), (2, 'Tom')])
+        self.assertEqual(pairs((r, l) for l, r in s.join('owners', 'owner_id', 'items', 'owner_id')),
+            [(1, 'Tom'), (2, 'Tom')])
+        self.assertEqual(pairs(s.join('items', 'owner_id', 'owners', 'owner_id', how='left')),
+            [(1, 'Tom'), (2, 'Tom'), (3, None)])
+        self.assertEqual(len(s.owners._indexes), 0)
+
+    def test_join_smaller_side(self):
+        s = self.s
+        s.items.add_row({'item_id':4, 'name':'table', 'owner_id':1})
+        s.owners.add_row({'owner_id':3, 'owner_name':'Bob'})
+        s.items._index_clear_all()
+        pairs = lambda it: sorted((l.item_id.value, r and r.owner_name.value) for l, r in it)
+        self.assertEqual(pairs(s.join('items', ['owner_id'], 'owners', ['owner_id'])),
+            [(1, 'Tom'), (2, 'Tom'), (4, 'Tom')])
+        self.assertEqual(list(s.owners._indexes), [('owner_id',)])
+        self.assertEqual(pairs(s.join('items', ['owner_id'], 'owners', ['owner_id'], 'left')),
+            [(1, 'Tom'), (2, 'Tom'), (3, None), (4, 'Tom')])
+        owners = sorted((l.owner_name.value, r and r.item_id.value)
+            for l, r in s.join('owners', 'owner_id', 'items', 'owner_id', 'left'))
+        self.assertEqual(owners, [('Bob', None), ('Tom', 1), ('Tom', 2), ('Tom', 4)])
+
+    def test_join_left_missing_columns(self):
+        s = self.s
+        s.items.add_row({'item_id':4, 'name':'free'})
+        s.items._index_clear_all()
+        pairs = lambda it: sorted((l.item_id.value, r and r.owner_name.value) for l, r in it)
+        expected = [(1, 'Tom'), (2, 'Tom'), (3, None), (4, None)]
+        # Index of smaller right table is probed.
+        self.assertEqual(pairs(s.join('items', 'owner_id', 'owners', 'owner_id', 'left')),
+            expected)
+        self.assertFalse(s.items._index_exists(('owner_id',)))
+        # Index of left table is probed.
+        s.owners.add_rows({'owner_id':i} for i in range(10, 20))
+        s.owners._index_clear_all()
+        self.assertEqual(pairs(s.join('items', 'owner_id', 'owners', 'owner_id', 'left')),
+            expected)
+        self.assertFalse(s.owners._index_exists(('owner_id',)))
+
+    def test_join_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            self.s.join('items', 'owner_id', 'owners', 'owner_id', how='right')
+        with self.assertRaises(ValueError):
+            self.s.join('items', 'owner_id name', 'owners', 'owner_id')
+
     def test_row_find_refs(self):
         s = self.s
         owned_items = s.owners[1].find_refs('items', 'owner_id')
@@ -45,9 +155,435 @@ class DBLikeTestCase(unittest.TestCase):
             ['chair','house']
         )
 
+    def test_group_by(self):
+        s = self.s
+        s.items.add_row({'item_id':4, 'name':'chair'})
+        self.assertEqual(s.items.group_by('name owner_id'), {
+            ('chair', 1): set([s.items[1]]),
+            ('house', 1): set([s.items[2]]),
+            ('mixer', 2): set([s.items[3]]),
+        })
+        self.assertFalse(s.items._index_exists(('name', 'owner_id')))
+        expected = {('chair',): set([s.items[1], s.items[4]]),
+            ('house',): set([s.items[2]]), ('mixer',): set([s.items[3]])}
+        self.assertEqual(s.items.group_by('name'), expected)
+        s.items.find_rows('name', ['chair'])
+        self.assertEqual(s.items.group_by(['name']), expected)
+
+    def test_aggregate(self):
+        s = self.s
+        s.items.add_rows([{'item_id':4, 'name':'table', 'owner_id':1, 'price':None},
+            {'item_id':5, 'name':'lamp', 'owner_id':2, 'price':5}])
+        expected = {
+            (1,): {'count': 3, 'sum': {'item_id': 7, 'price': None},
+                'min': {'name': 'chair'}, 'max': {'name': 'table'}},
+            (2,): {'count': 2, 'sum': {'item_id': 8, 'price': 5},
+                'min': {'name': 'lamp'}, 'max': {'name': 'mixer'}},
+        }
+        for with_index in [False, True]:
+            if with_index:
+                s.items.find_rows('owner_id', [1])
+            else:
+                s.items._index_clear_all() # drop index created by TableDef.refs
+            full_scans = s.items.stats()['full_scans']
+            self.assertEqual(s.items.aggregate('owner_id', sum='item_id price',
+                min=['name'], max='name'), expected)
+            self.assertEqual(s.items.aggregate('owner_id'),
+                {(1,): {'count': 3}, (2,): {'count': 2}})
+            self.assertEqual(s.items.aggregate('owner_id', count=False, max='price'),
+                {(1,): {'max': {'price': None}}, (2,): {'max': {'price': 5}}})
+            self.assertEqual(s.items.stats()['full_scans'] - full_scans,
+                0 if with_index else 3)
+
+
+class CompactDBLikeTestCase(DBLikeTestCase):
+    """Integration tests with compact row storage."""
+
+    storage = 'compact'
+
+
+class ColumnarDBLikeTestCase(DBLikeTestCase):
+    """Integration tests with columnar storage."""
+
+    storage = 'columnar'
+
+
+class SQLiteDBLikeTestCase(DBLikeTestCase):
+    """Integration tests with SQLite storage."""
+
+    storage = 'sqlite'
+
+
+class SnapshotDBLikeTestCase(DBLikeTestCase):
+    """Integration tests with schema reopened from snapshot."""
+
+    def setUp(self):
+        super(SnapshotDBLikeTestCase, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.s.save_snapshot(self.path)
+        self.s = DBSchema.open_snapshot(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_refs_index(self):
+        s = self.s
+        self.assertEqual(s.items._refs, {('owner_id',): 'owners'})
+        # Index is not built on open, so that rows are not decoded.
+        self.assertFalse(s.items._index_exists(('owner_id',)))
+
+
+class ThreadSafeDBLikeTestCase(DBLikeTestCase):
+    """Integration tests with thread-safe tables."""
+
+    thread_safe = True
+
+    def test_table_class(self):
+        self.assertTrue(isinstance(self.s.items, _LockedTableMixin))
+        self.assertTrue(isinstance(self.s.items, _DBTable))
+
+
+class ThreadSafeTestCase(unittest.TestCase):
+
+    storage = None
+
+    def test_index_built_once(self):
+        s = DBSchema(thread_safe=True,
+            schema_def=[TableDef(name='x', pk='k', storage=self.storage)])
+        s.x.add_rows({'k':i, 'val':i % 10} for i in range(1000))
+        built = []
+        index_create = s.x._index_create
+        def slow_index_create(column_names):
+            built.append(column_names)
+            time.sleep(0.05)
+            return index_create(column_names)
+        s.x._index_create = slow_index_create
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(len(s.x.find_rows('val', [3]))))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [100] * 5)
+        self.assertEqual(built, [('val',)])
+
+    def test_join_index_and_writer(self):
+        s = DBSchema(thread_safe=True, schema_def=[
+            TableDef(name='x', pk='k', storage=self.storage),
+            TableDef(name='y', pk='k', storage=self.storage)])
+        s.x.add_rows({'k':i, 'v':i} for i in range(10))
+        s.y.add_rows({'k':i, 'v':i % 10} for i in range(100))
+        # Index is built on the smaller table x.
+        group_rows = dblike._group_rows
+        def slow_group_rows(rows, column_names):
+            rows = list(rows)
+            time.sleep(0.1) # rows were read, index is not registered yet
+            return group_rows(rows, column_names)
+        def write():
+            time.sleep(0.02)
+            s.x.add_row({'k':100, 'v':3})
+        writer = threading.Thread(target=write)
+        dblike._group_rows = slow_group_rows
+        try:
+            writer.start()
+            pairs = list(s.join('x', 'v', 'y', 'v'))
+            writer.join()
+        finally:
+            dblike._group_rows = group_rows
+        self.assertTrue(len(pairs) in (100, 110))
+        self.assertEqual(len(s.x.find_rows('v', [3])), 2)
+
+    def test_join_and_writer(self):
+        s = DBSchema(thread_safe=True, schema_def=[
+            TableDef(name='x', pk='k', storage=self.storage),
+            TableDef(name='y', pk='k', storage=self.storage)])
+        s.x.add_rows({'k':i, 'v':i % 2} for i in range(50))
+        s.y.add_rows({'k':i, 'v':i % 2} for i in range(1000))
+        errors = []
+        def join():
+            try:
+                for x_row, y_row in s.join('x', 'v', 'y', 'v'):
+                    time.sleep(0) # let writer change index meanwhile
+            except Exception as e:
+                errors.append(e)
+        reader = threading.Thread(target=join)
+        reader.start()
+        for i in range(50, 150):
+            s.x.add_row({'k':i, 'v':i % 2})
+            time.sleep(0.001)
+        reader.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_readers_and_writer(self):
+        s = DBSchema(thread_safe=True,
+            schema_def=[TableDef(name='x', pk='k', storage=self.storage)])
+        s.x.add_row({'k':0, 'val':0})
+        find_rows = s.x.prepare_finder('val')
+        errors = []
+        def read():
+            try:
+                for i in range(200):
+                    for k, row in s.x.iteritems():
+                        row.val.value
+                    for row in s.x.find_rows('val', [0]):
+                        row.val.value
+                    for rows in s.x.find_rows_many('val', [[0], [1]]):
+                        list(rows)
+                    for row in find_rows([1]):
+                        row.val.value
+                    for rows in s.x.group_by('val').values():
+                        list(rows)
+                    list(s.x.where(val=0))
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read) for i in range(3)]
+        for thread in readers:
+            thread.start()
+        for i in range(1, 200):
+            s.x.add_row({'k':i, 'val':i % 2})
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(s.x.find_rows('val', [0])), 100)
+
+    def test_row_reads_and_writer(self):
+        s = DBSchema(thread_safe=True,
+            schema_def=[TableDef(name='x', pk='k', storage=self.storage)])
+        names = ['c{}'.format(i) for i in range(200)]
+        first = dict((name, 0) for name in names)
+        first['k'] = 0
+        s.x.add_row(first)
+        row = s.x[0]
+        errors = []
+        def read():
+            try:
+                for i in range(200):
+                    for name in names:
+                        self.assertEqual(getattr(row, name).value, 0)
+                    repr(row) # all columns of the row
+            except Exception as e:
+                errors.append(e)
+        reader = threading.Thread(target=read)
+        reader.start()
+        # New values of other types and new columns change the storage of the table.
+        for i, name in enumerate(names):
+            s.x.add_row({'k':i + 1, name:'text', 'new{}'.format(i):i})
+            time.sleep(0)
+        reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(row.c0.value, 0)
+
+    def test_concurrent_scans(self):
+        s = DBSchema(thread_safe=True, schema_def=[
+            TableDef(name='x', pk='k', storage=self.storage),
+            TableDef(name='y', pk='k', storage=self.storage)])
+        s.x.add_rows({'k':i} for i in range(100))
+        s.y.add_rows({'k':i} for i in range(10))
+        results = dict()
+        def scan(name):
+            try:
+                results[name] = [len(s[name].scan(lambda row: True, processes=2))
+                    for i in range(5)]
+            except Exception as e:
+                results[name] = e
+        threads = [threading.Thread(target=scan, args=(name,)) for name in 'xy']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {'x': [100] * 5, 'y': [10] * 5})
+
+    def test_rwlock(self):
+        lock = _RWLock()
+        with lock.reading():
+            with lock.reading(): # nested
+                self.assertEqual(lock._readers, 1)
+        with lock.writing():
+            with lock.reading(): # writer can read
+                with lock.writing(): # nested
+                    self.assertEqual(lock._readers, 0)
+        self.assertEqual(lock._writer, None)
+        events = []
+        def write():
+            with lock.writing():
+                events.append('write')
+        with lock.reading():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.05)
+            events.append('read')
+        writer.join()
+        self.assertEqual(events, ['read', 'write'])
+
+
+class ColumnarThreadSafeTestCase(ThreadSafeTestCase):
+    """Thread-safety tests with columnar storage."""
+
+    storage = 'columnar'
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        s = DBSchema(schema_def=[
+            TableDef(name='items', pk='item_id', refs={'owner_id': 'owners'}),
+            TableDef(name='owners', pk='owner_id'),
+        ])
+        s.owners.add_row({'owner_id':1})
+        s.items.add_rows({'item_id':i, 'owner_id':i % 2 + 1, 'name':'n'} for i in range(4))
+        self.s = s
+
+    def test_counters(self):
+        s = self.s
+        s.items.find_rows('name', ['n'])
+        s.items.find_rows('name', ['x'])
+        s.items.find_rows_many('name', ['n', 'x', 'y'])
+        s.items.find_rows('name', ['n'], skip_index=True)
+        s.owners[1].find_refs('items', 'owner_id') # index created by TableDef.refs
+        s.items.find_range('name')
+        s.items[0].owner_id.deref('owners')
+        with self.assertRaises(BrokenReferenceError):
+            s.items[1].owner_id.deref('owners')
+        s.deref_many([s.items[0].owner_id, s.items[1].owner_id], 'owners', 'none')
+        s.items.add_rows([{'item_id':0, 'name':'m'}], on_duplicate='replace')
+        stats = s.stats()
+        self.assertEqual(stats['items']['index_builds'], 2)
+        self.assertEqual(stats['items']['index_builds_by_columns'], {('name',): 2})
+        self.assertTrue(stats['items']['index_build_seconds'] >= 0)
+        self.assertEqual(stats['items']['index_rebuilds'], 3)
+        self.assertEqual(stats['items']['index_hits'], 3)
+        self.assertEqual(stats['items']['index_misses'], 3)
+        self.assertEqual(stats['items']['full_scans'], 1)
+        self.assertEqual(stats['owners']['derefs'], 4)
+        self.assertEqual(stats['owners']['broken_references'], 2)
+        self.assertEqual(stats['items']['derefs'], 0)
+
+    def test_deref_many_counters(self):
+        s = self.s
+        s.items.add_row({'item_id':4, 'owner_id':None})
+        values = [s.items[i].owner_id for i in (0, 1, 4)]
+        for missing in ('none', 'skip'):
+            s.deref_many(values, 'owners', missing)
+        with self.assertRaises(BrokenReferenceError):
+            s.deref_many(values, 'owners')
+        stats = s.owners.stats()
+        # Falsy value (no reference) is neither deref nor broken reference.
+        self.assertEqual(stats['derefs'], 6)
+        self.assertEqual(stats['broken_references'], 3)
+
+    def test_hook(self):
+        s = self.s
+        events = []
+        s.set_stats_hook(lambda *args: events.append(args))
+        s.items.find_rows('name', ['n'])
+        list(s.items.where(name='n'))
+        s.items.scan(lambda row: True)
+        self.assertEqual([e for e in events if e[1] != 'index_build_seconds'], [
+            ('items', 'index_builds', 1),
+            ('items', 'index_hits', 1),
+            ('items', 'full_scans', 1),
+        ])
+        s.set_stats_hook(None)
+        s.items.find_rows('name', ['n'])
+        self.assertEqual(len(events), 4)
+
+
+class MemoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.s = DBSchema(schema_def=[
+            TableDef(name='x', pk='k'),
+            TableDef(name='y', pk='k', storage='compact'),
+            TableDef(name='z', pk='k', storage='columnar'),
+        ])
+        for table in ('x', 'y', 'z'):
+            self.s[table].add_rows({'k':i, 'a':i % 10, 'b':str(i)} for i in range(100))
+
+    def test_memory_usage(self):
+        s = self.s
+        s.x.find_rows('a', [1])
+        s.x.find_range('b')
+        usage = s.memory_usage()
+        self.assertEqual(sorted(usage), ['x', 'y', 'z'])
+        x = usage['x']
+        self.assertEqual(sorted(x['indexes']), [('a',)])
+        self.assertEqual(sorted(x['sorted_indexes']), [('b',)])
+        self.assertEqual(x['total'], x['rows'] + x['indexes'][('a',)]
+            + x['sorted_indexes'][('b',)])
+        self.assertTrue(x['rows'] > usage['y']['rows'] > 0)
+        self.assertTrue(usage['z']['rows'] > 0)
+        self.assertEqual(usage['y']['indexes'], {})
+
+    def test_memory_usage_keeps_rows(self):
+        rows = [self.s.y[1], self.s.z[1]]
+        referents = [gc.get_referents(row) for row in rows]
+        self.s.memory_usage()
+        # Rows do not get empty __dict__ by being measured.
+        self.assertEqual([gc.get_referents(row) for row in rows], referents)
+
+    def test_memory_usage_grows(self):
+        before = self.s.y.memory_usage()['rows']
+        self.s.y.add_rows({'k':i, 'a':i % 10, 'b':str(i)} for i in range(100, 200))
+        self.assertTrue(self.s.y.memory_usage()['rows'] > before)
+
+    def test_index_budget(self):
+        s = self.s
+        s.set_index_budget(10 ** 9)
+        s.x.find_rows('a', [1])
+        s.y.find_rows('a', [1])
+        s.y.find_range('b')
+        usage = s.memory_usage()
+        s.x.find_rows('a', [2]) # y.a is least recently used
+        s.set_index_budget(usage['x']['indexes'][('a',)]
+            + usage['y']['sorted_indexes'][('b',)])
+        self.assertEqual(list(s.y._indexes), [])
+        self.assertEqual(list(s.y._sorted_indexes), [('b',)])
+        self.assertEqual(list(s.x._indexes), [('a',)])
+        self.assertEqual(s.y.stats()['index_evictions'], 1)
+        # Evicted index is rebuilt, others are evicted instead.
+        self.assertEqual(len(s.y.find_rows('a', [1])), 10)
+        self.assertTrue(s.y._index_exists(('a',)))
+        self.assertEqual(s.y.stats()['index_builds'], 3)
+        self.assertEqual(s.y.stats()['index_evictions'], 2)
+        # Newest index is kept, even if it alone exceeds the budget.
+        s.set_index_budget(1)
+        self.assertEqual(list(s.y._indexes), [('a',)])
+        self.assertEqual(list(s.x._indexes), [])
+        s.set_index_budget(None)
+        s.x.find_rows('a', [1])
+        s.x.find_rows('b', ['1'])
+        self.assertEqual(len(s.x._indexes), 2)
+
+    def test_index_budget_after_add_rows(self):
+        s = self.s
+        s.set_index_budget(10 ** 9)
+        s.x.find_rows('b', ['1'])
+        s.x.find_rows('a', [1])
+        s.set_index_budget(sum(s.x.memory_usage()['indexes'].values()))
+        self.assertEqual(len(s.x._indexes), 2)
+        s.x.add_rows({'k':i, 'a':i % 10, 'b':str(i)} for i in range(100, 200))
+        self.assertEqual(list(s.x._indexes), [('a',)])
+        self.assertEqual(len(s.x.find_rows('b', ['150'])), 1)
+
+
+def parse_test_shard(shard):
+    """Parse function for `DBSchema.load_parallel` tests."""
+    for table_name, k in shard:
+        value_dict = {'k':k, 'val':'{}{}'.format(table_name, k)}
+        if k == 3:
+            value_dict['extra'] = k
+        yield table_name, value_dict
+
 
 class DBSchemaTestCase(unittest.TestCase):
 
+    def test_table_def_storage(self):
+        s = DBSchema(schema_def=[('a', 'k'), TableDef(name='b', pk='k', storage='compact')])
+        self.assertEqual(type(s.a), _DBTable)
+        self.assertEqual(type(s.b), _CompactTable)
+
     def test_getattr(self):
         s = DBSchema(schema_def=[TableDef(name='test_table', pk='k')])
         s.test_table.add_row({'k':1, 'val':'valueX'})
@@ -58,11 +594,161 @@ class DBSchemaTestCase(unittest.TestCase):
         s.test_table.add_row({'k':1, 'val':'valueX'})
         self.assertEqual(s['test_table'][1].val.value, 'valueX')
 
+    def test_load(self):
+        s = DBSchema(schema_def=[TableDef(name='a', pk='k'), TableDef(name='b', pk='k')])
+        s.load({
+            'a': [{'k':1, 'val':'a1'}, {'k':2, 'val':'a2'}],
+            'b': iter([{'k':1, 'val':'b1'}]),
+        })
+        self.assertEqual(s.a[2].val.value, 'a2')
+        self.assertEqual(s.b[1].val.value, 'b1')
+
+    def test_table_def_loader(self):
+        calls = []
+        def load_owners():
+            calls.append('owners')
+            return [{'owner_id':1, 'owner_name':'Tom'}]
+        def load_items():
+            calls.append('items')
+            # Other tables of the schema can be used while loading.
+            owner = s.owners[1]
+            yield {'item_id':1, 'name':'chair', 'owner_id':owner.owner_id.value}
+        s = DBSchema(schema_def=[
+            TableDef(name='items', pk='item_id', refs={'owner_id': 'owners'},
+                loader=[load_items, lambda: [{'item_id':2, 'owner_id':2}]]),
+            TableDef(name='owners', pk='owner_id', loader=load_owners),
+        ])
+        self.assertTrue('items' in s)
+        self.assertEqual(calls, [])
+        self.assertEqual(s.items[1].name.value, 'chair')
+        self.assertEqual(calls, ['items', 'owners'])
+        self.assertEqual(s.items[1].owner_id.deref('owners').owner_name.value, 'Tom')
+        self.assertEqual(len(s.owners.find_rows('owner_name', ['Tom'])), 1)
+        self.assertEqual(len(s.check_references()), 1)
+        self.assertEqual(calls, ['items', 'owners'])
+
+    def test_table_def_loader_failed(self):
+        def load():
+            yield {'k':1}
+            raise IOError('broken shard')
+        s = DBSchema(schema_def=[TableDef(name='a', pk='k', loader=load)])
+        with self.assertRaises(IOError):
+            s.a
+        self.assertEqual(s._tables['a'].values(), [])
+        s._loaders['a'] = lambda: [{'k':1}]
+        self.assertEqual(s.a[1].k.value, 1)
+
+    def test_table_def_loader_snapshot(self):
+        s = DBSchema(schema_def=[TableDef(name='a', pk='k'), TableDef(name='b', pk='k')])
+        s.load({'a': [{'k':1, 'val':'a1'}], 'b': [{'k':1}]})
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            s.save_snapshot(path)
+            lazy = DBSchema(schema_def=[
+                TableDef(name='a', pk='k', storage='compact', loader=path)])
+            self.assertEqual(type(lazy.a), _CompactTable)
+            self.assertEqual(lazy.a[1].val.value, 'a1')
+        finally:
+            os.remove(path)
+
+    xml_dump = (b'<schema><meta>ignored</meta>'
+        b'<owners><owner owner_id="1"><owner_name>Tom</owner_name></owner></owners>'
+        b'<items>'
+        b'<item item_id="1" owner_id="1"><name>chair</name></item>'
+        b'<item item_id="2" owner_id="1"><name>house</name></item>'
+        b'<item item_id="3" owner_id="2"><name/></item>'
+        b'</items></schema>')
+
+    def test_from_xml(self):
+        s = DBSchema.from_xml(io.BytesIO(self.xml_dump), {
+            'owner': TableDef(name='owners', pk='owner_id'),
+            'item': TableDef(name='items', pk='item_id', storage='compact'),
+        })
+        self.assertEqual(s.owners['1'].owner_name.value, 'Tom')
+        self.assertEqual(s.items['2'].name.value, 'house')
+        self.assertEqual(s.items['3'].name.value, None)
+        self.assertEqual(s.items['1'].owner_id.deref('owners').owner_name.value, 'Tom')
+        self.assertEqual(len(s.items.values()), 3)
+        self.assertFalse('meta' in s)
+
+    def test_load_xml(self):
+        s = DBSchema(schema_def=[TableDef(name='items', pk='item_id')])
+        s.load_xml(io.BytesIO(self.xml_dump), {'item': 'items'}, batch_size=2)
+        self.assertEqual(sorted(k for k, v in s.items.iteritems()), ['1', '2', '3'])
+        self.assertEqual(len(s.items.find_rows('owner_id', ['1'])), 2)
+
+    def test_load_xml_nested_rows(self):
+        s = DBSchema(schema_def=[TableDef(name='owners', pk='owner_id'),
+            TableDef(name='items', pk='item_id')])
+        s.load_xml(io.BytesIO(b'<schema>'
+            b'<owner owner_id="1"><owner_name>Tom</owner_name>'
+            b'<item item_id="1"><name>chair</name></item></owner>'
+            b'</schema>'), {'owner': 'owners', 'item': 'items'})
+        self.assertEqual(s.owners['1']._plain_columns(),
+            {'owner_id': '1', 'owner_name': 'Tom'})
+        self.assertEqual(s.items['1']._plain_columns(), {'item_id': '1', 'name': 'chair'})
+
+    def test_check_references_composite(self):
+        s = DBSchema(schema_def=[
+            TableDef(name='a', pk='k m'),
+            TableDef(name='b', pk='k', refs={'a_k a_m': 'a'}),
+        ])
+        s.a.add_row({'k':1, 'm':1})
+        s.b.add_rows([{'k':1, 'a_k':1, 'a_m':1}, {'k':2, 'a_k':1, 'a_m':2}, {'k':3}])
+        errors = s.check_references()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]._src, ('b', 'k', (2,)))
+        self.assertEqual(errors[0]._col, ('a_k', 'a_m'))
+        self.assertEqual(errors[0]._trg, ('a', 'k m', (1, 2)))
+        self.assertEqual(len(s.a[1, 1].find_refs('b', 'a_k a_m')), 1)
+
+    def test_load_parallel(self):
+        shards = [[('a', 1), ('b', 1), ('a', 2)], [('a', 3)], []]
+        for processes in [1, 2]:
+            s = DBSchema(schema_def=[TableDef(name='a', pk='k'), TableDef(name='b', pk='k')])
+            s.load_parallel(shards, parse_test_shard, processes)
+            self.assertEqual(sorted(k for k, v in s.a.iteritems()), [1, 2, 3])
+            self.assertEqual(s.a[2].val.value, 'a2')
+            self.assertEqual(s.b[1].val.value, 'b1')
+            self.assertEqual(s.a[3].extra.value, 3)
+            with self.assertRaises(KeyError):
+                s.a[1].extra
+
+    def test_load_parallel_duplicate(self):
+        s = DBSchema(schema_def=[TableDef(name='a', pk='k'), TableDef(name='b', pk='k')])
+        with self.assertRaises(DuplicateRowException) as cm:
+            s.load_parallel([[('a', 1)], [('a', 1)]], parse_test_shard, 2)
+        self.assertEqual(cm.exception.table_name, 'a')
+        s.load_parallel([[('a', 1)], [('a', 2)]], parse_test_shard, 2, on_duplicate='skip')
+        self.assertEqual(len(s.a.values()), 2)
+
     def test_contains(self):
         s = DBSchema(schema_def=[TableDef(name='test_table', pk='k')])
         self.assertTrue('test_table' in s)
         self.assertFalse('test_tabl' in s)
 
+    def test_table_def_intern(self):
+        for storage in [None, 'compact', 'columnar']:
+            s = DBSchema(schema_def=[
+                TableDef(name='a', pk='k', storage=storage, intern='status'),
+                TableDef(name='b', pk='k', storage=storage, intern=True),
+            ])
+            s.a.add_row({'k':1, 'status':''.join(['op', 'en']), 'note':''.join(['x', 'y'])})
+            s.a.add_rows([{'k':2, 'status':''.join(['op', 'en']), 'note':''.join(['x', 'y'])},
+                {'k':3, 'status':1}, {'k':4, 'status':1.0}])
+            self.assertTrue(s.a[1].status.value is s.a[2].status.value)
+            if storage != 'columnar': # `_Column` shares values anyway
+                self.assertFalse(s.a[1].note.value is s.a[2].note.value)
+            self.assertEqual(type(s.a[4].status.value), float)
+            self.assertEqual(len(s.a.find_rows('status', ['open'])), 2)
+            key, = [k for k in s.a._indexes[('status',)] if k == ('open',)]
+            self.assertTrue(key[0] is s.a[1].status.value)
+            s.b.add_rows({'k':i, 'note':''.join(['x', 'y'])} for i in range(3))
+            s.b.add_row({'k':3, 'note':[1]}) # unhashable
+            self.assertTrue(s.b[0].note.value is s.b[2].note.value)
+            self.assertEqual(s.b[3].note.value, [1])
+
 
 class DBTableTestCase(unittest.TestCase):
 
@@ -146,6 +832,184 @@ class DBTableTestCase(unittest.TestCase):
         x._index_clear_all()
         self.assertFalse(x._index_exists(('val',)))
 
+    def test_index_maintained_on_add_row(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1', 'other':'a'})
+        x.add_row({'row_id':2, 'val':'valueX', 'other':'b'})
+        x._index_create(('val',))
+        x._index_create(('val', 'other'))
+        index_val = x._indexes[('val',)]
+        x.add_row({'row_id':3, 'val':'valueX', 'other':'a'})
+        x.add_row({'row_id':4, 'val':'value4', 'other':'b'})
+        # Existing index is updated in place, not dropped.
+        self.assertTrue(x._indexes[('val',)] is index_val)
+        self.assertEqual(x.find_rows('val', ['valueX']), set([x[2], x[3]]))
+        self.assertEqual(x.find_rows('val', ['value4']), set([x[4]]))
+        # Contents match freshly built index.
+        for column_names in [('val',), ('val', 'other')]:
+            maintained = dict(x._indexes[column_names])
+            x._index_create(column_names)
+            self.assertEqual(maintained, x._indexes[column_names])
+
+    def test_index_not_changed_on_duplicate(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        x._index_create(('val',))
+        with self.assertRaises(DuplicateRowException):
+            x.add_row({'row_id':1, 'val':'value2'})
+        self.assertEqual(x._indexes[('val',)], {('value1',): set([x[1]])})
+
+    def test_index_column_order_normalized(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1', 'other':'a'})
+        x.add_row({'row_id':2, 'val':'valueX', 'other':'b'})
+        self.assertEqual(x.find_rows(['val', 'other'], ['valueX', 'b']), set([x[2]]))
+        self.assertEqual(x.find_rows(['other', 'val'], ['b', 'valueX']), set([x[2]]))
+        self.assertEqual(list(x._indexes), [('other', 'val')])
+        self.assertEqual(x.find_rows_many(['val', 'other'], [('value1', 'a'), ('value1', 'b')]),
+            [set([x[1]]), set()])
+        self.assertEqual(x.stats()['index_builds'], 1)
+
+    def test_index_prefix_reused(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1', 'other':'a'})
+        x.add_row({'row_id':2, 'val':'valueX', 'other':'b'})
+        x.add_row({'row_id':3, 'val':'valueX', 'other':'c'})
+        x._index_build(('other', 'row_id', 'val'))
+        # Leading columns are served by existing index.
+        self.assertEqual(x.find_rows('other', ['b']), set([x[2]]))
+        self.assertEqual(x.find_rows(['row_id', 'other'], ['c', 3]), set())
+        self.assertEqual(x.find_rows(['row_id', 'other'], [3, 'c']), set([x[3]]))
+        self.assertEqual(x.find_rows_many('other', ['a', 'd']), [set([x[1]]), set()])
+        self.assertEqual(x.stats()['index_builds'], 1)
+        # Prefix lookups see added rows.
+        x.add_row({'row_id':4, 'val':'value4', 'other':'b'})
+        self.assertEqual(x.find_rows('other', ['b']), set([x[2], x[4]]))
+        self.assertEqual(x.find_rows('other', ['d']), set())
+        # Index not starting with the columns is not used.
+        self.assertEqual(x.find_rows('val', ['valueX']), set([x[2], x[3]]))
+        self.assertEqual(x.stats()['index_builds'], 2)
+
+    def test_index_prefix_missing_columns(self):
+        x = _DBTable(parent_schema=None, name='x', pk='id')
+        x.add_row({'id':1, 'a':1, 'b':1})
+        x.add_row({'id':2, 'a':1})
+        self.assertEqual(x.find_rows('a b', [1, 1]), set([x[1]]))
+        # Index on ('a', 'b') lacks row 2, so it is not used for ('a',).
+        self.assertEqual(x.find_rows('a', [1]), set([x[1], x[2]]))
+        self.assertEqual(x.find_rows('a', [1]), x.find_rows('a', [1], skip_index=True))
+        # Index becomes partial after prefix lookups.
+        y = _DBTable(parent_schema=None, name='y', pk='id')
+        y.add_row({'id':1, 'a':1, 'b':1})
+        y.find_rows('a b', [1, 1])
+        self.assertEqual(y.find_rows('a', [1]), set([y[1]]))
+        self.assertEqual(y.stats()['index_builds'], 1)
+        y.add_row({'id':2, 'a':1})
+        self.assertEqual(y.find_rows('a', [1]), set([y[1], y[2]]))
+        self.assertEqual(y.stats()['index_builds'], 2)
+
+    def test_index_prefix_memory_usage(self):
+        x = _DBTable(parent_schema=None, name='x', pk='id')
+        x.add_rows({'id':i, 'a':i % 10} for i in range(100))
+        x.find_rows('a id', [1, 1])
+        size = x.memory_usage()['indexes'][('a', 'id')]
+        x.find_rows('a', [1])
+        self.assertTrue(x.memory_usage()['indexes'][('a', 'id')] > size)
+
+    def test_group_by_normalized_index(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1', 'other':'a'})
+        x.add_row({'row_id':2, 'val':'valueX', 'other':'b'})
+        x.find_rows(['val', 'other'], ['valueX', 'b'])
+        scans = x.stats()['full_scans']
+        self.assertEqual(x.group_by(['val', 'other']),
+            {('value1', 'a'): set([x[1]]), ('valueX', 'b'): set([x[2]])})
+        self.assertEqual(x.aggregate(['val', 'other']),
+            {('value1', 'a'): {'count': 1}, ('valueX', 'b'): {'count': 1}})
+        self.assertEqual(x.stats()['full_scans'], scans)
+
+    def test_get_many(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_rows({'row_id':i} for i in range(3))
+        self.assertEqual(x.get_many([2, 0]), [x[2], x[0]])
+        with self.assertRaises(RowKeyError) as cm:
+            x.get_many([2, 5])
+        self.assertEqual(str(cm.exception), 'RowKeyError(x, row_id, (5,))')
+        self.assertEqual(x.get_many([2, 5, 1], missing='none'), [x[2], None, x[1]])
+        self.assertEqual(x.get_many([2, 5, 1], missing='skip'), [x[2], x[1]])
+        with self.assertRaises(ValueError):
+            x.get_many([2], missing='ignore')
+
+    def test_get_many_multikey(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id m')
+        x.add_row({'row_id':1, 'm':100})
+        self.assertEqual(x.get_many([(1, 100), (1, 1)], missing='none'), [x[1, 100], None])
+
+    def test_find_rows_many(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        x.add_row({'row_id':2, 'val':'valueX'})
+        x.add_row({'row_id':3, 'val':'valueX'})
+        queries = [('valueX',), 'value1', ['nothing'], ('valueX',)]
+        expected = [set([x[2], x[3]]), set([x[1]]), set(), set([x[2], x[3]])]
+        self.assertEqual(x.find_rows_many('val', queries), expected)
+        self.assertEqual(x.find_rows_many('val', queries, skip_index=True), expected)
+        self.assertEqual(x.find_rows_many('val row_id', [('valueX', 3)]), [set([x[3]])])
+
+    def test_scan(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_rows({'row_id':i, 'val':i % 7} for i in range(100))
+        predicate = lambda row: row.val.value == 3 and row.row_id.value > 50
+        expected = set([x[52], x[59], x[66], x[73], x[80], x[87], x[94]])
+        self.assertEqual(x.scan(predicate), expected)
+        self.assertEqual(x.scan(predicate, processes=2), expected)
+        self.assertEqual(x.scan(lambda row: False, processes=3), set())
+
+    def test_rows_without_indexed_column(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        x._index_create(('val',))
+        x.add_row({'row_id':2})
+        self.assertEqual(x.find_rows('val', ['value1']), set([x[1]]))
+        self.assertEqual(x.find_rows('val', ['value1'], True), set([x[1]]))
+        self.assertEqual(x.find_range('val'), [x[1]])
+
+    def test_find_range(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_rows({'row_id':i, 'val':'value{}'.format(i % 3)} for i in range(1, 10))
+        ids = lambda rows: [r.row_id.value for r in rows]
+        self.assertEqual(ids(x.find_range(['row_id'], [3], [5])), [3, 4, 5])
+        self.assertEqual(ids(x.find_range(['row_id'], [3], [5], False, False)), [4])
+        self.assertEqual(ids(x.find_range(['row_id'], None, [2])), [1, 2])
+        self.assertEqual(ids(x.find_range(['row_id'], [8])), [8, 9])
+        self.assertEqual(ids(x.find_range(['row_id'], [20])), [])
+        # Composite columns and bounds shorter than columns.
+        self.assertEqual(ids(x.find_range('val row_id', 'value1', 'value1')), [1, 4, 7])
+        self.assertEqual(ids(x.find_range('val row_id', ('value1', 4), 'value1')), [4, 7])
+        self.assertEqual(ids(x.find_range('val row_id', 'value1', 'value1', False)), [])
+        self.assertEqual(ids(x.find_range('val row_id', None, 'value0', True, False)), [])
+
+    def test_find_prefix(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        for i, name in enumerate(['abd', 'ab', 'abc', 'b', 'a', None, 5, 'abc']):
+            x.add_row({'row_id':i, 'name':name})
+        names = lambda rows: [(r.name.value, r.row_id.value) for r in rows]
+        self.assertEqual(names(x.find_prefix('name row_id', 'ab')),
+            [('ab', 1), ('abc', 2), ('abc', 7), ('abd', 0)])
+        self.assertEqual(names(x.find_prefix('name', 'c')), [])
+
+    def test_sorted_index_maintained(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':5, 'val':'value5'})
+        x.find_range(['row_id'])
+        x.add_row({'row_id':1, 'val':'value1'})
+        x.add_rows([{'row_id':3, 'val':'value3'}, {'row_id':9, 'val':'value9'}])
+        self.assertEqual([r.row_id.value for r in x.find_range('row_id')], [1, 3, 5, 9])
+        x.add_rows([{'row_id':3, 'val':'new'}], on_duplicate='replace')
+        self.assertEqual([r.val.value for r in x.find_range('row_id', [2], [4])], ['new'])
+        x._index_clear_all()
+        self.assertEqual(x._sorted_indexes, {})
+
     def test_contains_multikey(self):
         x = _DBTable(parent_schema=None, name='x', pk='row_id m')
         x.add_row({'row_id':1, 'm':100, 'val':'value1'})
@@ -184,6 +1048,491 @@ class DBTableTestCase(unittest.TestCase):
         self.assertEqual(cm.exception.table_name, 'x')
 
 
+    def test_add_rows(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id m')
+        x.add_row({'row_id':1, 'm':1, 'val':'valueX'})
+        x._index_create(('val',))
+        x.add_rows(({'row_id':i, 'm':1, 'val':'valueX'} for i in range(2, 5)))
+        self.assertEqual(len(x.values()), 4)
+        self.assertEqual(x[3, 1].val.value, 'valueX')
+        self.assertEqual(len(x.find_rows('val', ['valueX'])), 4)
+
+    def test_add_rows_duplicate_raise(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        with self.assertRaises(DuplicateRowException) as cm:
+            x.add_rows([{'row_id':2, 'val':'value2'}, {'row_id':1, 'val':'new'}])
+        self.assertEqual(cm.exception.table_name, 'x')
+        self.assertEqual(cm.exception.existing_row, x[1])
+        self.assertFalse(2 in x) # table is not changed
+        with self.assertRaises(DuplicateRowException) as cm:
+            x.add_rows([{'row_id':2, 'val':'value2'}, {'row_id':2, 'val':'new'}])
+        self.assertFalse(2 in x)
+
+    def test_add_rows_duplicate_skip(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        x.add_rows([{'row_id':1, 'val':'new'}, {'row_id':2, 'val':'value2'},
+            {'row_id':2, 'val':'new'}], on_duplicate='skip')
+        self.assertEqual(x[1].val.value, 'value1')
+        self.assertEqual(x[2].val.value, 'value2')
+
+    def test_add_rows_duplicate_replace(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        x._index_create(('val',))
+        x.add_rows([{'row_id':1, 'val':'new'}, {'row_id':2, 'val':'value2'},
+            {'row_id':2, 'val':'new'}], on_duplicate='replace')
+        self.assertEqual(x[1].val.value, 'new')
+        self.assertEqual(x[2].val.value, 'new')
+        self.assertEqual(x.find_rows('val', ['value1']), set())
+        self.assertEqual(x.find_rows('val', ['new']), set([x[1], x[2]]))
+
+    def test_add_rows_bad_on_duplicate(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        with self.assertRaises(ValueError):
+            x.add_rows([], on_duplicate='ignore')
+
+
+class CompactTableTestCase(unittest.TestCase):
+
+    def test_row_values(self):
+        x = _CompactTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'value1'})
+        x.add_row({'row_id':2, 'other':'other2'})
+        self.assertEqual(type(x[1]), _CompactRow)
+        self.assertEqual(x[1].val.value, 'value1')
+        self.assertEqual(x[2].other.value, 'other2')
+        self.assertEqual(x[2].column_values('other row_id'), ('other2', 2))
+        # Columns missing in a row behave as in _DBRow.
+        with self.assertRaises(KeyError):
+            x[1].other
+        with self.assertRaises(KeyError):
+            x[2].val
+        with self.assertRaises(KeyError):
+            x[1].column_values('other')
+
+    def test_shared_layout(self):
+        x = _CompactTable(parent_schema=None, name='x', pk='row_id')
+        x.add_rows([{'row_id':1, 'val':'value1'}, {'row_id':2, 'val':'value2'}])
+        self.assertEqual(x._layout, {'row_id':0, 'val':1})
+        self.assertEqual(x[2]._values, (2, 'value2'))
+        self.assertFalse(hasattr(x[2], '__dict__'))
+
+    def test_find_rows(self):
+        x = _CompactTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'valueX'})
+        x.add_row({'row_id':2, 'val':'value2'})
+        x.add_row({'row_id':3, 'val':'valueX'})
+        self.assertEqual(x.find_rows('val', ['valueX']), set([x[1], x[3]]))
+        self.assertEqual(x.find_rows('val', ['valueX'], True), set([x[1], x[3]]))
+
+    def test_repr(self):
+        x = _CompactTable(parent_schema=None, name='x', pk='a')
+        x.add_row({'a':1, 'c':'c1'})
+        self.assertEqual(repr(x[1]), repr(
+            _DBRow(parent_schema=None, table=None, pk='a', value_dict={'a':1, 'c':'c1'})
+        ))
+
+
+class ColumnarTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        x = _ColumnarTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'valueX', 'num':1.5})
+        x.add_row({'row_id':2, 'val':'value2', 'num':2.5})
+        x.add_row({'row_id':3, 'val':'valueX', 'num':1.5, 'extra':'e3'})
+        x.add_row({'row_id':4, 'val':'valueX', 'num':None})
+        self.x = x
+
+    def test_row_values(self):
+        x = self.x
+        self.assertEqual(type(x[1]), _ColumnarRow)
+        self.assertEqual(x[1].val.value, 'valueX')
+        self.assertFalse(hasattr(x[1], '__dict__'))
+        self.assertEqual(x[2].column_values('num row_id'), (2.5, 2))
+        self.assertEqual(x[3].extra.value, 'e3')
+        self.assertEqual(x[4].num.value, None)
+        with self.assertRaises(KeyError):
+            x[1].extra
+        with self.assertRaises(KeyError):
+            x[1].unknown
+        self.assertEqual(sorted(x[3]._columns), ['extra', 'num', 'row_id', 'val'])
+
+    def test_storage(self):
+        x = self.x
+        self.assertEqual(x._layout['row_id']._array.typecode, 'l')
+        self.assertTrue(x._layout['val']._array is None)
+        self.assertEqual(x._layout['val']._values, ['valueX', 'value2'])
+        # Column with None is converted to dictionary encoding.
+        self.assertTrue(x._layout['num']._array is None)
+        self.assertEqual(x._layout['num']._values, [1.5, 2.5, None])
+
+    def test_walking_find_rows(self):
+        x = self.x
+        self.assertEqual(x.find_rows('val', ['valueX'], True), set([x[1], x[3], x[4]]))
+        self.assertEqual(x.find_rows(('val', 'num'), ('valueX', 1.5), True), set([x[1], x[3]]))
+        self.assertEqual(x.find_rows(('row_id',), (2.0,), True), set([x[2]]))
+        self.assertEqual(x.find_rows(('row_id',), ('2',), True), set())
+        self.assertEqual(x.find_rows(('extra',), ('e3',), True), set([x[3]]))
+        self.assertEqual(x.find_rows(('unknown',), ('e3',), True), set())
+        self.assertEqual(x.find_rows(('val', 'num'), ('valueX', 1.5), True),
+            x.find_rows(('val', 'num'), ('valueX', 1.5)))
+
+    def test_walking_find_rows_skips_not_added(self):
+        x = self.x
+        with self.assertRaises(DuplicateRowException):
+            x.add_row({'row_id':1, 'val':'valueX'})
+        x.add_rows([{'row_id':3, 'val':'value3'}], on_duplicate='replace')
+        self.assertEqual(x.find_rows('val', ['valueX'], True), set([x[1], x[4]]))
+        self.assertEqual(x.find_rows('val', ['value3'], True), set([x[3]]))
+
+    def test_column(self):
+        column = _Column(2)
+        self.assertEqual([column[0], column[1]], [_MISSING, _MISSING])
+        column = _Column(0)
+        column.append(1)
+        column.append(2)
+        self.assertEqual(column._array.tolist(), [1, 2])
+        column.append(['unhashable'])
+        column.append(2)
+        self.assertEqual(column._codes.tolist(), [0, 1, 2, 1])
+        self.assertEqual([column[pos] for pos in range(4)], [1, 2, ['unhashable'], 2])
+        self.assertEqual(column.positions(2), [1, 3])
+        self.assertEqual(column.positions(2, [0, 1]), [1])
+
+
+class SQLiteTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        x = _SQLiteTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'val':'valueX', 'num':1})
+        x.add_rows([{'row_id':2, 'val':'value2', 'num':'1'},
+            {'row_id':3, 'val':'valueX', 'num':1.0, 'extra':(1, 2)},
+            {'row_id':4, 'val':None, 'num':2 ** 70}])
+        self.x = x
+
+    def test_rows(self):
+        x = self.x
+        self.assertEqual(type(x._rows), _SQLiteRows)
+        self.assertEqual(len(x._rows), 4)
+        self.assertEqual(x[3].extra.value, (1, 2))
+        self.assertEqual(x[2].num.value, '1')
+        self.assertTrue(2.0 in x)
+        self.assertFalse(5 in x)
+        with self.assertRaises(RowKeyError):
+            x[5]
+        self.assertEqual(sorted(k for k, v in x.iteritems()), [1, 2, 3, 4])
+        with self.assertRaises(DuplicateRowException):
+            x.add_row({'row_id':1})
+        with self.assertRaises(TypeError):
+            x.add_row({'row_id':(1, 2)}) # unsupported pk value
+
+    def test_find_rows(self):
+        x = self.x
+        for skip_index in [True, False]:
+            self.assertEqual(x.find_rows('num', [1], skip_index), set([x[1], x[3]]))
+            self.assertEqual(x.find_rows('num', ['1'], skip_index), set([x[2]]))
+            self.assertEqual(x.find_rows('num', [2 ** 70], skip_index), set([x[4]]))
+            self.assertEqual(x.find_rows('extra', [(1, 2)], skip_index), set([x[3]]))
+            self.assertEqual(x.find_rows('val', [None], skip_index), set([x[4]]))
+            self.assertEqual(x.find_rows('extra', [None], skip_index), set())
+            self.assertEqual(x.find_rows('unknown', [None], skip_index), set())
+        self.assertEqual(x.find_rows_many('val', [['valueX'], ['none']]),
+            [set([x[1], x[3]]), set()])
+        sql_indexes = [name for name, in x._rows._db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertTrue('dblike-index:x:num' in sql_indexes)
+        self.assertTrue('dblike-index:x:val' in sql_indexes)
+
+    def test_replace(self):
+        x = self.x
+        x.find_rows('val', ['valueX'])
+        x.add_rows([{'row_id':3, 'val':'value3'}], on_duplicate='replace')
+        self.assertEqual(len(x._rows), 4)
+        self.assertEqual(x[3].val.value, 'value3')
+        self.assertEqual(x.find_rows('val', ['valueX']), set([x[1]]))
+        self.assertEqual(x.find_rows('val', ['value3']), set([x[3]]))
+
+    def test_index_after_miss(self):
+        x = self.x
+        find_rows = x.prepare_finder('val')
+        self.assertEqual(x.find_rows('val', ['value5']), set())
+        self.assertFalse(('value5',) in x._indexes[('val',)])
+        x.add_row({'row_id':5, 'val':'value5'})
+        self.assertEqual(find_rows(['value5']), set([x[5]]))
+        self.assertEqual(x._indexes[('val',)][('value5',)], set([x[5]]))
+        self.assertEqual(x.find_rows('val', ['value5']), set([x[5]]))
+
+    def test_cache(self):
+        s = DBSchema([TableDef(name='x', pk='k', storage='sqlite')], sqlite_cache_rows=2)
+        s.x.add_rows({'k':i, 'val':str(i)} for i in range(5))
+        self.assertTrue(s.x[1] is s.x[1])
+        self.assertEqual(len(s.x.values()), 5)
+        self.assertEqual(len(s.x._rows._cache), 2)
+        self.assertEqual(s.x[1].val.value, '1')
+
+    def test_sqlite_path(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            s = DBSchema([TableDef(name='x', pk='k', storage='sqlite'),
+                TableDef(name='y', pk='k', storage='sqlite')], sqlite_path=path)
+            s.x.add_row({'k':1, 'val':'a'})
+            s.y.add_row({'k':1, 'val':'b'})
+            self.assertEqual(s.y[1].val.value, 'b')
+            self.assertTrue(s.x._rows._db is s.y._rows._db)
+            s._sqlite.close()
+            self.assertTrue(os.path.getsize(path) > 0)
+        finally:
+            os.remove(path)
+
+    def test_snapshot(self):
+        s = DBSchema([TableDef(name='x', pk='row_id', storage='sqlite')])
+        s.x.add_rows(row._plain_columns() for row in self.x.values())
+        s.x.find_rows('val', ['valueX'])
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            s.save_snapshot(path, indexes=True)
+            snapshot = DBSchema.open_snapshot(path)
+            self.assertEqual(snapshot.x[3].extra.value, (1, 2))
+        finally:
+            os.remove(path)
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_save_open(self):
+        s = DBSchema(schema_def=[TableDef(name='x', pk='row_id m'),
+            TableDef(name='y', pk='k', storage='columnar')])
+        s.x.add_row({'row_id':1, 'm':1, 'val':'value1'})
+        s.x.add_row({'row_id':2, 'm':1, 'val':None, 'num':2.5})
+        s.y.add_row({'k':'a', 'val':'valueY'})
+        s.save_snapshot(self.path)
+        s2 = DBSchema.open_snapshot(self.path)
+        self.assertEqual(type(s2.x), _SnapshotTable)
+        self.assertEqual(s2.x._pk, 'row_id m')
+        self.assertEqual(s2.x._rows._decoded, {}) # nothing decoded yet
+        self.assertEqual(s2.x[2, 1].num.value, 2.5)
+        self.assertEqual(s2.x[2, 1].val.value, None)
+        self.assertEqual(len(s2.x._rows._decoded), 1)
+        self.assertTrue(s2.x[2, 1] is s2.x[2, 1])
+        self.assertEqual(s2.y['a'].val.value, 'valueY')
+        self.assertEqual(sorted(k for k, v in s2.x.iteritems()), [(1, 1), (2, 1)])
+        self.assertTrue((1, 1) in s2.x)
+        self.assertFalse((3, 1) in s2.x)
+        with self.assertRaises(RowKeyError):
+            s2.x[3, 1]
+
+    def test_add_row_after_open(self):
+        s = DBSchema(schema_def=[TableDef(name='x', pk='row_id')])
+        s.x.add_row({'row_id':1, 'val':'value1'})
+        s.save_snapshot(self.path)
+        s2 = DBSchema.open_snapshot(self.path)
+        with self.assertRaises(DuplicateRowException):
+            s2.x.add_row({'row_id':1, 'val':'value1'})
+        s2.x.add_row({'row_id':2, 'val':'value1'})
+        self.assertEqual(len(s2.x.values()), 2)
+        self.assertEqual(len(s2.x.find_rows('val', ['value1'])), 2)
+        s2.x.add_rows([{'row_id':1, 'val':'new'}], on_duplicate='replace')
+        self.assertEqual(s2.x[1].val.value, 'new')
+        self.assertEqual(len(s2.x.values()), 2)
+        self.assertEqual(s2.x.find_rows('val', ['value1']), set([s2.x[2]]))
+
+    def test_indexes(self):
+        s = DBSchema(schema_def=[TableDef(name='x', pk='row_id')])
+        s.x.add_row({'row_id':1, 'val':'valueX'})
+        s.x.add_row({'row_id':2, 'val':'value2'})
+        s.x.add_row({'row_id':3, 'val':'valueX'})
+        s.x.find_rows('val', ['valueX'])
+        s.save_snapshot(self.path, indexes=True)
+        s2 = DBSchema.open_snapshot(self.path)
+        self.assertEqual(list(s2.x._snapshot_indexes), [('val',)])
+        self.assertEqual(s2.x.find_rows('val', ['valueX']), set([s2.x[1], s2.x[3]]))
+        self.assertEqual(len(s2.x._rows._decoded), 3)
+
+    def test_not_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+        with self.assertRaises(ValueError):
+            DBSchema.open_snapshot(self.path)
+
+
+class FrozenTestCase(unittest.TestCase):
+
+    def setUp(self):
+        s = DBSchema(schema_def=[
+            TableDef(name='items', pk='item_id', refs={'owner_id': 'owners'}),
+            TableDef(name='owners', pk='owner_id', storage='columnar'),
+        ])
+        s.owners.add_row({'owner_id':1, 'owner_name':'Tom'})
+        s.items.add_row({'item_id':1, 'name':'chair', 'owner_id':1})
+        s.items.add_row({'item_id':2, 'name':'house', 'owner_id':1})
+        s.items.add_row({'item_id':3, 'name':'mixer', 'owner_id':2, 'price':5})
+        self.s = s
+        self.f = s.freeze()
+
+    def test_freeze(self):
+        f = self.f
+        self.assertEqual(type(f.items), _FrozenTable)
+        self.assertEqual(f.items[3].price.value, 5)
+        self.assertEqual(f.items[3].column_values('name owner_id'), ('mixer', 2))
+        with self.assertRaises(KeyError):
+            f.items[1].price
+        self.assertEqual(f.items[1].owner_id.deref('owners').owner_name.value, 'Tom')
+        self.assertEqual(f.owners[1].find_refs('items', 'owner_id'),
+            set([f.items[1], f.items[2]]))
+        self.assertEqual(sorted(k for k, v in f.items.iteritems()), [1, 2, 3])
+        self.assertEqual(len(f.check_references()), 1)
+        # Rows are views, that are not kept by the table.
+        self.assertFalse(f.items[1] is f.items[1])
+        self.assertEqual(f.items[1], f.items[1])
+        self.assertNotEqual(f.items[1], f.items[2])
+
+    def test_hash_collisions(self):
+        self.assertEqual(hash(-1), hash(-2))
+        s = DBSchema(schema_def=[TableDef(name='x', pk='k')])
+        s.x.add_rows({'k':k, 'val':-k % 3 - 2} for k in range(-20, 1))
+        s.x.find_rows('val', [-1])
+        f = s.freeze()
+        for k in range(-20, 1):
+            self.assertEqual(f.x[k].k.value, k)
+        self.assertFalse(-21 in f.x)
+        self.assertEqual(sorted(f.x._rows), [(k,) for k in range(-20, 1)])
+        self.assertEqual(sorted(r.k.value for r in f.x.find_rows('val', [-1])),
+            sorted(r.k.value for r in s.x.find_rows('val', [-1])))
+        self.assertEqual(len(f.x.find_rows('val', [-2])), 7)
+        self.assertEqual(sorted(f.x.group_by('val')), [(-2,), (-1,), (0,)])
+
+    def test_read_only(self):
+        f = self.f
+        with self.assertRaises(TypeError):
+            f.items.add_row({'item_id':4})
+        with self.assertRaises(TypeError):
+            f.items.add_rows([{'item_id':4}])
+        with self.assertRaises(TypeError):
+            f.load({'owners': [{'owner_id':2}]})
+        self.assertEqual(len(f.items.values()), 3)
+        # Original schema is not affected.
+        self.s.items.add_row({'item_id':4})
+        self.assertEqual(len(f.items.values()), 3)
+
+    def test_indexes(self):
+        f = self.f
+        # Saved index is searched in the buffer.
+        self.assertTrue(isinstance(f.items._indexes[('owner_id',)], _FrozenIndex))
+        self.assertEqual(f.items.find_rows('owner_id', [2]), set([f.items[3]]))
+        self.assertEqual(f.items.find_rows('owner_id', [3]), set())
+        self.assertEqual(f.items.group_by('owner_id'),
+            {(1,): set([f.items[1], f.items[2]]), (2,): set([f.items[3]])})
+        self.assertEqual(f.items.find_rows('name', ['house']), set([f.items[2]]))
+        self.assertEqual(sorted(r.item_id.value for r in f.items.find_range('item_id', [2])),
+            [2, 3])
+        self.assertEqual(f.items.stats()['index_builds'], 2)
+        f.items._index_clear_all()
+        self.assertEqual(list(f.items._indexes), [('owner_id',)])
+        usage = f.items.memory_usage()
+        self.assertTrue(usage['rows'] >= sys.getsizeof(f.items._buf))
+        self.assertTrue(usage['indexes'][('owner_id',)] > 0)
+
+
+class QueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_rows({'row_id':i, 'owner_id':i % 3, 'name':'name{}'.format(i % 4)}
+            for i in range(12))
+        x.add_row({'row_id':12, 'name':'name0'})
+        self.x = x
+
+    def ids(self, query):
+        return sorted(row.row_id.value for row in query)
+
+    def test_where(self):
+        x = self.x
+        self.assertEqual(self.ids(x.where(owner_id=1)), [1, 4, 7, 10])
+        self.assertEqual(self.ids(x.where(owner_id=1).where(name='name0')), [4])
+        self.assertEqual(self.ids(x.where(owner_id=1, name__in=['name0', 'name3'])), [4, 7])
+        self.assertEqual(self.ids(x.where(owner_id__ne=1, row_id__lt=4)), [0, 2, 3])
+        self.assertEqual(self.ids(x.where(row_id__ge=10)), [10, 11, 12])
+        self.assertEqual(self.ids(x.where(row_id__gt=10, row_id__le=11)), [11])
+        self.assertEqual(self.ids(x.where(name='name0', owner_id__in=[0, 2])), [0, 8])
+        self.assertEqual(self.ids(x.where(unknown=1)), [])
+
+    def test_select(self):
+        x = self.x
+        self.assertEqual(sorted(x.where(owner_id=1).select('name', 'row_id')),
+            [('name0', 4), ('name1', 1), ('name2', 10), ('name3', 7)])
+        self.assertEqual(sorted(x.where(owner_id=1, row_id__lt=5).select('row_id')),
+            [(1,), (4,)])
+
+    def test_lazy(self):
+        x = self.x
+        query = x.where(owner_id=1)
+        x.add_row({'row_id':13, 'owner_id':1})
+        self.assertEqual(self.ids(query), [1, 4, 7, 10, 13])
+
+    def test_plan(self):
+        x = self.x
+        query = x.where(owner_id=1, name='name3', row_id__gt=6)
+        self.assertEqual(len(list(query._plan()[0][0])), 13) # full scan
+        x.find_rows('owner_id', [1])
+        x.find_rows('name', ['name3'])
+        candidates, used = query._plan()
+        self.assertEqual(candidates, [set([x[3], x[7], x[11]])])
+        self.assertEqual(used, set([0]))
+        self.assertEqual(self.ids(query), [7])
+        query = x.where(owner_id=1, name='name3', row_id__gt=10)
+        x.find_range('row_id')
+        candidates, used = query._plan()
+        self.assertEqual(candidates, [[x[11], x[12]]])
+        self.assertEqual(used, set([2]))
+        self.assertEqual(self.ids(query), [])
+        x.find_rows('name owner_id', ['name3', 1])
+        candidates, used = query._plan()
+        self.assertEqual(candidates, [set([x[7]])])
+        self.assertEqual(used, set([0, 1]))
+
+    def test_plan_sorted_index_missing_columns(self):
+        x = _DBTable(parent_schema=None, name='x', pk='row_id')
+        x.add_row({'row_id':1, 'a':1, 'b':1})
+        x.add_row({'row_id':2, 'a':2})
+        x.find_range('a b')
+        # Row 2 lacks 'b', so it is not in the index.
+        self.assertEqual(self.ids(x.where(a__ge=1)), [1, 2])
+        x.find_range('a')
+        query = x.where(a__ge=2)
+        self.assertEqual(query._plan()[0], [[x[2]]])
+        self.assertEqual(self.ids(query), [2])
+
+    def test_plan_index_prefix(self):
+        x = self.x
+        x.find_rows('name row_id', ['name3', 3])
+        query = x.where(name__in=['name1', 'name3'])
+        candidates, used = query._plan()
+        self.assertEqual(sorted(len(c) for c in candidates), [3, 3])
+        self.assertEqual(used, set([0]))
+        self.assertEqual(self.ids(query), [1, 3, 5, 7, 9, 11])
+        self.assertEqual(x.stats()['index_builds'], 1)
+
+    def test_plan_index_prefix_missing_columns(self):
+        x = self.x
+        x._index_clear_all()
+        # Row 12 lacks owner_id, so it is not in the index.
+        x.find_rows('name owner_id', ['name0', 0])
+        query = x.where(name='name0')
+        self.assertEqual(len(list(query._plan()[0][0])), 13) # full scan
+        self.assertEqual(self.ids(query), [0, 4, 8, 12])
+
+
 class DBRowTestCase(unittest.TestCase):
 
     def test_getattr(self):
@@ -251,6 +1600,25 @@ class DBValueTestCase(unittest.TestCase):
         self.assertFalse(_DBValue(parent_schema=None, parent_row=None, colname=None, value=''))
 
 
+class BenchmarkTestCase(unittest.TestCase):
+    def test_generate_schema(self):
+        from benchmarks.generator import SchemaShape, generate_schema
+        s = generate_schema(SchemaShape(tables=2, rows=50, fanout=10, cardinality=3))
+        self.assertEqual(len(s.t0.values()), 50)
+        self.assertEqual(len(s.t1.values()), 5)
+        for row in s.t0.values():
+            self.assertTrue(row.parent_id.deref('t1'))
+
+    def test_benchmark_storage(self):
+        from benchmarks.generator import SchemaShape
+        from benchmarks.run import benchmark_storage
+        shape = SchemaShape(tables=2, rows=50, fanout=10, cardinality=3)
+        results = benchmark_storage(shape, 'compact', lookups=10)
+        names = set(r['benchmark'] for r in results)
+        self.assertTrue({'memory', 'add_row', 'find_rows_cold', 'find_rows_warm',
+            'find_refs', 'deref', 'iteritems'} <= names)
+
+
 class OtherTestCase(unittest.TestCase):
 
     def test_tupulize_cols(self):